@@ -16,23 +16,116 @@
 #       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #       MA 02110-1301, USA.
 
-from sys import stderr
-from collections import deque
+from bisect import bisect_left
+from collections import OrderedDict
+from math import gcd
+from struct import pack
+from sys import modules, stderr
 
 OPCODES = '.abcdefghijklmnopqrstuvwxyzGHIJKLMNOPQRSTUVWXYZ'
 HEXDIGITS = '0123456789ABCDEF'
 MAXINT = 0xFFFFFFFF
 
-class Melody:
-    def __init__(self, melody, mutedlines=[]):
+SAMPLERATE = 8000  # samples per second, see FORMAT-draft-erlehmann 3.4
+
+# grammar limits, see FORMAT-draft-erlehmann 2
+TITLE_CHARACTERS = frozenset('abcdefghijklmnopqrstuvwxyz0123456789_')
+CHARACTERS = frozenset(OPCODES + HEXDIGITS)  # of lines; also A-F, without G-Z
+LINE_MAX = 16  # characters per title or line
+LINES_MAX = 16
+NUMBER_MAX = 8  # digits
+GLITCH_MAX = LINE_MAX + LINES_MAX * (1 + LINE_MAX) + 1  # with a final LF
+
+# blocks of at least this many samples are rendered with NumPy if possible
+VECTORIZE_MIN = 4096
+
+# importing NumPy takes about as long as computing this many samples
+# without it, so it is only imported once as many have been asked for
+VECTORIZE_IMPORT_MIN = 131072
+
+# fewer samples than this are not worth starting processes for
+PARALLEL_MIN = 65536
+
+# samples written at once by file renderers
+BLOCKSIZE = 65536
+
+# optimized code kept for this many programs, least recently used dropped
+OPTIMIZE_CACHE_MAX = 256
+_optimized = OrderedDict()
+
+# defaults for Melody.checkpoint_interval and Melody.checkpoint_max
+CHECKPOINT_INTERVAL = 65536
+CHECKPOINT_MAX = 64
+
+# samples repeating every CYCLE_MAX samples or less are kept once a whole
+# cycle of them has been computed, see Cycle
+CYCLE_MAX = 1 << 20
+
+# default for Melody.cycle_block; stacks seen at the most recent
+# CYCLE_STACKS block boundaries are compared with the current one
+CYCLE_BLOCK = 4096
+CYCLE_STACKS = 256
+
+# integer opcodes, indexing DISPATCH
+(OP_NUMBER, OP_T, OP_PUT, OP_DROP, OP_MUL, OP_DIV, OP_ADD, OP_SUB, OP_MOD,
+ OP_LSHIFT, OP_RSHIFT, OP_AND, OP_OR, OP_XOR, OP_NOT, OP_DUP, OP_PICK,
+ OP_SWAP, OP_LT, OP_GT, OP_EQ) = range(21)
+
+# superinstructions created by _optimize_
+OP_CONSTANTS, OP_BINARY_CONSTANT, OP_T_BINARY_CONSTANT = range(21, 24)
+
+BINARY_OPCODES = (OP_MUL, OP_DIV, OP_ADD, OP_SUB, OP_MOD, OP_LSHIFT,
+    OP_RSHIFT, OP_AND, OP_OR, OP_XOR, OP_LT, OP_GT, OP_EQ)
+
+OPCODE_NUMBERS = {
+    'a': OP_T, 'b': OP_PUT, 'c': OP_DROP, 'd': OP_MUL, 'e': OP_DIV,
+    'f': OP_ADD, 'g': OP_SUB, 'h': OP_MOD, 'j': OP_LSHIFT, 'k': OP_RSHIFT,
+    'l': OP_AND, 'm': OP_OR, 'n': OP_XOR, 'o': OP_NOT, 'p': OP_DUP,
+    'q': OP_PICK, 'r': OP_SWAP, 's': OP_LT, 't': OP_GT, 'u': OP_EQ
+}
+
+class GlitchError(ValueError):
+    def __init__(self, diagnostics):
+        """
+        A GlitchError is raised for glitches not following the grammar;
+        diagnostics is a list of (line, column, reason) tuples, counting
+        the title as line 0.
+        """
+        ValueError.__init__(self, '\n'.join(['line %d, column %d: %s' % \
+            diagnostic for diagnostic in diagnostics]))
+        self.diagnostics = diagnostics
+
+class Melody(object):
+    def __init__(self, melody, mutedlines=[], strict=False):
         """
         A Melody consists of lines signifying opcodes and hexadecimal numbers.
         [a-z] and [G-Z] denote opcodes, while [1-9] and [A-F] denote numbers.
+
+        Glitches not following the grammar raise a GlitchError if strict
+        is true; otherwise, what can be interpreted is, and the problems
+        are kept in self.warnings. See parse.
         """
+        self.lines, self.warnings = parse(melody, strict)
+
+        # stack snapshots are taken every checkpoint_interval samples;
+        # when there are more than checkpoint_max of them, every other
+        # one is dropped and the interval is doubled.
+        self.checkpoint_interval = CHECKPOINT_INTERVAL
+        self.checkpoint_max = CHECKPOINT_MAX
+
+        # while samples are computed in order, the stack is compared with
+        # earlier ones every cycle_block samples, see _find_cycle_
+        self.cycle_block = CYCLE_BLOCK
+
+        # a glitch_profile.Profile collecting statistics, if profiling
+        self.profile = None
+        # a glitch_tap.Tap recording the stack, if visualising it
+        self.tap = None
 
-        assert(type(melody) == str)
+        # samples skipped since the cells were last brought up to date,
+        # as (t after the last one, count); see _catch_up_
+        self._skipped = None
 
-        self.lines = melody.split('!')
         self.title = self.lines[0]
         self.tokens = self._tokenize_(self.lines[1:], mutedlines)
         self._reset_()
@@ -49,32 +142,172 @@ class Melody:
         return leadchar + '!'.join(lines).strip('!')
 
     def _reset_(self):
-        self.stack = deque([0] * 256)
+        # The stack is a ring buffer of 256 cells with a top-of-stack
+        # pointer that wraps around, see FORMAT-draft-erlehmann 3.1.
+        self.cells = [0] * 256
+        self.sp = 0
+        # t of the next sample, while samples are computed in order
+        # starting at zero; None otherwise
+        self.t = 0
+
+    def _get_stack_(self):
+        """
+        Returns the 256 stack cells ordered from bottom to top, the last
+        item being the top of stack.
+        """
+        cells = self.cells
+        sp = self.sp + 1
+        return cells[sp:] + cells[:sp]
+
+    stack = property(_get_stack_)
+
+    def _get_cells_(self):
+        self._catch_up_()
+        return self._cells
+
+    def _set_cells_(self, cells):
+        self._cells = cells
+        self._skipped = None
+
+    cells = property(_get_cells_, _set_cells_)
+
+    def _get_tokens_(self):
+        return self._tokens
+
+    def _set_tokens_(self, tokens):
+        self._catch_up_()  # with the program copied samples came from
+        self._tokens = tokens
+        self.program = self._compile_(tokens)
+        self._update_()
+
+    def _update_(self):
+        """
+        Derives everything else from self.program after it changed.
+        """
+        # what _interpret_ executes; cached, as edits often return to an
+        # earlier program (cycling through opcodes, muting and unmuting)
+        key = tuple(self.program)
+        try:
+            self.code = _optimized.pop(key)
+        except KeyError:
+            self.code = _optimize_(self.program)
+        _optimized[key] = self.code
+        while len(_optimized) > OPTIMIZE_CACHE_MAX:
+            _optimized.popitem(last=False)
+        self.function = None  # generated by glitch_codegen when needed
+        self.expression, self.delta = _analyze_(self.program)
+        self._memory = False  # not analyzed yet
+        self.checkpoints = {}  # t: (cells, sp) before computing sample t
+        self.cycle = None  # a Cycle once found, False if none is kept
+        # (cells, sp, bits of t): t of the stacks seen, see _find_cycle_
+        self.stacks = OrderedDict()
+        self._mask = False  # not analyzed yet
+
+    # assigning tokens (as glitched does after edits) recompiles the program
+    tokens = property(_get_tokens_, _set_tokens_)
+
+    def _get_memory_(self):
+        """
+        Returns the number of passes after which samples no longer depend
+        on an earlier stack, or None if they always might; see _memory_.
+        """
+        if self._memory is False:
+            self._memory = _memory_(self.program)
+        return self._memory
+
+    memory = property(_get_memory_)
 
     def _tokenize_(self, lines, mutedlines=[]):
+        """
+        Splits lines into tokens. The (line, column) of each token is
+        stored in self.positions, counting the title as line 0; the
+        indices of muted lines are stored in self.mutedlines.
+        """
         tokens = []
-
-        STATE_NUMBER = False
+        self.positions = []
+        self.mutedlines = set(mutedlines)
 
         for i, line in enumerate(lines):
-            assert(len(line) <= 16)  # only 16 characters per line allowed
             if i in mutedlines:
                 continue
 
-            for char in line:
-                if (char in HEXDIGITS) and STATE_NUMBER:
-                    tokens[-1] += char
-                elif (char != '.'):
-                    tokens.append(char)
-
-                if (char in HEXDIGITS):
-                    STATE_NUMBER = True
-                else:
-                    STATE_NUMBER = False
-            STATE_NUMBER = False  # new lines begin new numbers
+            line_tokens, positions = _tokenize_line_(i + 1, line)
+            tokens.extend(line_tokens)
+            self.positions.extend(positions)
 
         return tokens
 
+    def set_char(self, row, column, char, reset=False):
+        """
+        Replaces the character at column of line row, counting the title
+        as line 0, and recompiles only that line. The stack is kept, so
+        the melody changes without a discontinuity, unless reset is true.
+
+        Characters not allowed in the line raise a GlitchError, and the
+        melody stays as it was.
+        """
+        if not 0 <= column < LINE_MAX:
+            raise ValueError('only %d characters per line allowed' % LINE_MAX)
+        if row == 0:
+            allowed = TITLE_CHARACTERS.union('.')  # padding, see _expand_
+        else:
+            allowed = CHARACTERS
+        if not (isinstance(char, str) and (len(char) == 1) and \
+            (char in allowed)):
+            raise GlitchError([(row, column, '%r not allowed' % (char,))])
+        while len(self.lines) <= row:
+            self.lines.append('')
+        line = self.lines[row].ljust(column, '.')
+        self.lines[row] = line[:column] + char + line[column+1:]
+        if row == 0:
+            self.title = self.lines[0]
+        else:
+            self._patch_line_(row, reset)
+
+    def mute_line(self, row, muted=True, reset=False):
+        """
+        Mutes or unmutes line row, counting the title as line 0, and
+        recompiles only that line; see set_char.
+        """
+        if row < 1:
+            raise ValueError('the title is not code')
+        if muted:
+            self.mutedlines.add(row - 1)
+        else:
+            self.mutedlines.discard(row - 1)
+        self._patch_line_(row, reset)
+
+    def _patch_line_(self, row, reset):
+        """
+        Replaces the tokens and instructions of line row by those of its
+        current text; positions tell which ones came from the line.
+        """
+        self._catch_up_()
+        if len(self.positions) != len(self._tokens):  # not from _tokenize_
+            self.tokens = self._tokenize_(self.lines[1:], self.mutedlines)
+        else:
+            if (row - 1) in self.mutedlines:
+                tokens, positions = [], []
+            else:
+                tokens, positions = _tokenize_line_(row, self.lines[row])
+            program, origins = _translate_(tokens, positions)
+
+            start = bisect_left(self.positions, (row,))
+            end = bisect_left(self.positions, (row + 1,))
+            self._tokens[start:end] = tokens
+            self.positions[start:end] = positions
+
+            start = bisect_left(self.origins, (row,))
+            end = bisect_left(self.origins, (row + 1,))
+            self.program[start:end] = program
+            self.origins[start:end] = origins
+            self._update_()
+
+        if reset:
+            self._reset_()
+        else:
+            self.t = None  # the stack is no longer that of a reset melody
+
     def _expand_(self, lines):
         """
             Appends NOPs to all lines for easy editing.
@@ -85,140 +318,1225 @@ class Melody:
             except IndexError:
                 self.lines.append(16*'.')
 
+    def _compile_(self, tokens):
+        """
+        Translates tokens into a program of (opcode, argument) pairs.
+        Numbers are parsed once here; reserved opcodes are dropped.
+        The source position of every instruction is kept in self.origins.
+        """
+        positions = getattr(self, 'positions', [])
+        if len(positions) != len(tokens):  # tokens not from _tokenize_
+            positions = [(None, None)] * len(tokens)
+
+        program, self.origins = _translate_(tokens, positions)
+        return program
+
     def _compute_(self, t, count=1):
-        stack = self.stack
-        for token in self.tokens:
-            if not token in OPCODES:  # not an opcode, must be a number
-                stack.append((int(token, 16)))
-                stack.popleft()
-
-            elif (token == 'a'):  # OP_T
-                stack.append(t & MAXINT)
-                stack.popleft()
-
-            elif (token == 'b'):  # OP_PUT
-                a = stack[-1] % 256
-                stack[-a-1] = stack[-2]
-                stack.rotate(1)
-
-            elif (token == 'c'):  # OP_DROP
-                stack.rotate(1)
-
-            elif (token == 'd'):  # OP_MUL
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                stack.append((b * a) & MAXINT)
-
-            elif (token == 'e'):  # OP_DIV
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                try:
-                    stack.append(int(b / a) & MAXINT)
-                except ZeroDivisionError:
-                    stack.append(0)
-
-            elif (token == 'f'):  # OP_ADD
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                stack.append((b + a) & MAXINT)
-
-            elif (token == 'g'):  # OP_SUB
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                stack.append((b - a) & MAXINT)
-
-            elif (token == 'h'):  # OP_MOD
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                try:
-                    stack.append((b % a) & MAXINT)
-                except ZeroDivisionError:
-                    stack.append(0)
-
-            elif (token == 'j'):  # OP_LSHIFT
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                if a < 32:
-                    stack.append((b << a) & MAXINT)
-                else:
-                    stack.append(0)
-
-            elif (token == 'k'):  # OP_RSHIFT
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                if a < 32:
-                    stack.append((b >> a) & MAXINT)
-                else:
-                    stack.append(0)
-
-            elif (token == 'l'):  # OP_AND
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                stack.append((b & a) & MAXINT)
-
-            elif (token == 'm'):  # OP_OR
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                stack.append((b | a) & MAXINT)
-
-            elif (token == 'n'):  # OP_XOR
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                stack.append((b ^ a) & MAXINT)
-
-            elif (token == 'o'):  # OP_NOT
-                stack[-1] = (~stack[-1] & MAXINT)
-
-            elif (token == 'p'):  # OP_DUP
-                stack.append(stack[-1])
-                stack.popleft()
-
-            elif (token == 'q'):  # OP_PICK
-                # 0 OP_PICK is equivalent to OP_DUP
-                # 0xFF OP_PICK is equivalent to 0xFF
-                a = stack[-1]
-                stack[-1] = stack[-((a-254) % 256)]
-
-            elif (token == 'r'):  # OP_SWAP
-                stack[-1], stack[-2] = stack[-2], stack[-1]
-
-            elif (token == 's'):  # OP_LT
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                if (b < a):
-                    stack.append(MAXINT)
+        if t == self.t:
+            if t % self.checkpoint_interval == 0:
+                self._checkpoint_()
+            self.t = t + 1
+        else:
+            self.t = None
+
+        if self.profile is not None:
+            buf = bytearray(1)
+            self.profile.render(self, t, 1, buf)
+            return buf[0]
+
+        cells = self.cells
+        sp = self.sp
+        t = t & MAXINT
+        for opcode, argument in self.code:
+            sp = DISPATCH[opcode](cells, sp, t, argument)
+        self.sp = sp
+
+        result = cells[sp]
+        return result & 0xFF
+
+    def render(self, start, count, out=None):
+        """
+        Computes count samples beginning at t = start.
+
+        If out (a bytearray or writable memoryview) is given, the samples
+        are written to its first count bytes and out is returned;
+        otherwise a new bytes object is returned. The stack carries over
+        between samples just as with successive calls to _compute_.
+
+        Large blocks of stateless melodies are computed using NumPy, if
+        it is available. Samples repeating in a cycle (see Cycle) are
+        copied once a whole cycle of them has been computed, unless tap
+        is recording them.
+        """
+        if out is None:
+            buf = bytearray(count)
+        else:
+            buf = out
+
+        if start != self.t:
+            self.t = None
+
+        if self.profile is not None:
+            self.profile.render(self, start, count, buf)
+        elif self.tap is not None:
+            self.tap.render(self, start, count, buf)
+        elif self.expression is not None:
+            self._render_stateless_(start, count, buf)
+        elif self.t is None:
+            self._render_(start, count, buf)
+        else:
+            self._render_blocks_(start, count, buf)
+
+        if self.t is not None:
+            self.t = start + count
+
+        if out is None:
+            return bytes(buf)
+        return out
+
+    def _render_stateless_(self, start, count, buf):
+        """
+        Computes count samples of a stateless melody into buf. Its samples
+        repeat (see _period_); once a whole cycle of them is kept, they
+        are copied from it, and the cells are only brought up to date
+        when they are used, see _catch_up_.
+        """
+        cycle = self.cycle
+        if cycle is None:
+            period = _period_(self.expression)
+            if period <= CYCLE_MAX:
+                cycle = self.cycle = Cycle(0, period)
+            else:
+                cycle = self.cycle = False
+
+        if cycle and cycle.complete:
+            cycle.copy(start, count, buf)
+            self._skip_(start, count)
+            return
+
+        if cycle:
+            # compute only what completes the cycle, copy the rest
+            n = cycle.remaining(start)
+            if n < count:
+                view = memoryview(buf)
+                self._render_stateless_(start, n, view[:n])
+                self._render_stateless_(start + n, count - n, view[n:])
+                return
+
+        if (count >= VECTORIZE_MIN) and _load_vectorizer_(count):
+            _vectorizer.render(self, start, count, buf)
+        else:
+            self._render_(start, count, buf)
+        if cycle:
+            cycle.keep(start, memoryview(buf)[:count])
+
+    def skip(self, start, count):
+        """
+        Advances a stateless melody over count samples beginning at t =
+        start as if they were computed, for samples known from elsewhere
+        (see glitch_cache). The cells are only brought up to date when
+        they are used, see _catch_up_.
+        """
+        if self.expression is None:
+            raise ValueError('only stateless melodies can skip samples')
+        if start != self.t:
+            self.t = None
+        self._skip_(start, count)
+        if self.t is not None:
+            self.t = start + count
+
+    def _skip_(self, start, count):
+        skipped = self._skipped
+        if (skipped is None) or (skipped[0] != start):
+            self._catch_up_()
+            skipped = (start, 0)
+        self.sp = (self.sp + count * self.delta) & 0xFF
+        self._skipped = (start + count, skipped[1] + count)
+
+    def _catch_up_(self):
+        """
+        Brings the cells up to date after samples of a stateless melody
+        were skipped (copied from its cycle, for example), by computing
+        the last of them again: every pass writes the same cells as the
+        one 256 // gcd(delta, 256) passes before, so earlier passes leave
+        nothing behind.
+        """
+        if self._skipped is None:
+            return
+        end, count = self._skipped
+        self._skipped = None
+        n = min(count, 256 // gcd(self.delta, 256))
+        self.sp = (self.sp - n * self.delta) & 0xFF
+        self._render_(end - n, n, bytearray(n))
+
+    def _render_blocks_(self, start, count, buf):
+        """
+        Computes count samples in order into buf, block by block: the
+        stack is stored for seek every checkpoint_interval samples and
+        compared with earlier ones every cycle_block samples (see
+        _find_cycle_). Blocks of a cycle already kept are copied.
+        """
+        view = memoryview(buf)
+        offset = 0
+        while offset < count:
+            t = start + offset
+            # checkpoints are only needed if seek can not replay
+            if (self.memory is None) and (t % self.checkpoint_interval == 0):
+                self.t = t
+                self._checkpoint_()
+            if t % self.cycle_block == 0:
+                self._find_cycle_(t)
+            n = min(count - offset,
+                self.checkpoint_interval - t % self.checkpoint_interval,
+                self.cycle_block - t % self.cycle_block)
+            block = view[offset:offset+n]
+            if not self._repeat_(t, n, block):
+                self._render_(t, n, block)
+                if self.cycle:
+                    self.cycle.keep(t, block)
+            offset += n
+
+    def _find_cycle_(self, t):
+        """
+        Compares the stack before computing sample t, a block boundary
+        reached computing samples in order, with those seen at earlier
+        ones. Passes depend on t only through its bits in _cycle_mask_;
+        once the stack and those bits are the same as at an earlier t,
+        samples and stacks repeat from there on. A Cycle of them is kept
+        from t on, with the stack at every block boundary.
+        """
+        cycle = self.cycle
+        if cycle is None:
+            if self._mask is False:
+                self._mask = _cycle_mask_(self.program)
+            if self._mask >= CYCLE_MAX:  # no cycle can be short enough
+                self.cycle = False
+                return
+            key = (tuple(self.cells), self.sp, t & self._mask)
+            length = abs(t - self.stacks.get(key, t))
+            if 0 < length <= CYCLE_MAX:
+                cycle = self.cycle = Cycle(t, length)
+                self.stacks.clear()
+            else:
+                self.stacks[key] = t
+                while len(self.stacks) > CYCLE_STACKS:
+                    self.stacks.popitem(last=False)
+
+        if cycle and (t >= cycle.start) and (not cycle.complete) and \
+            (cycle.phase(t) == cycle.filled):
+            cycle.stacks[cycle.filled] = (tuple(self.cells), self.sp)
+
+    def _repeat_(self, t, count, buf):
+        """
+        Copies count samples from t into buf from the cycle, if it is kept
+        and the stack after them is known, and sets the stack to that.
+        Returns whether it did.
+        """
+        cycle = self.cycle
+        if (not cycle) or (not cycle.complete) or (t < cycle.start):
+            return False
+        stack = cycle.stacks.get(cycle.phase(t + count))
+        if stack is None:
+            return False
+        cycle.copy(t, count, buf)
+        self.cells[:] = stack[0]
+        self.sp = stack[1]
+        return True
+
+    def _checkpoint_(self):
+        """
+        Stores a snapshot of the stack for seeking to self.t later.
+        """
+        self.checkpoints[self.t] = (list(self.cells), self.sp)
+        if len(self.checkpoints) > self.checkpoint_max:
+            self.checkpoint_interval *= 2
+            for t in list(self.checkpoints.keys()):
+                if t % self.checkpoint_interval:
+                    del self.checkpoints[t]
+
+    def seek(self, t):
+        """
+        Sets the stack to what it would be before computing the sample at
+        t, if all samples before were computed in order after a reset.
+
+        Melodies that forget their stack (see memory) only need to
+        compute the memory samples preceding t, and none at all if they
+        are stateless; the cells they never read back may then differ.
+        Other melodies are restored from the nearest checkpoint before t
+        (or reset) and compute the samples from there.
+        """
+        self._catch_up_()
+        memory = self.memory
+        if (memory is not None) and (t >= memory):
+            self.sp = ((t - memory) * self.delta) & 0xFF
+            self.t = t - memory
+            start = t - memory
+        else:
+            start = max([c for c in self.checkpoints if c <= t] + [-1])
+            if start < 0:
+                self._reset_()
+                start = 0
+            else:
+                cells, self.sp = self.checkpoints[start]
+                self.cells = list(cells)
+                self.t = start
+
+        buf = bytearray(BLOCKSIZE)
+        for offset in range(start, t, BLOCKSIZE):
+            self.render(offset, min(BLOCKSIZE, t - offset), buf)
+        self.t = t
+
+    def _render_(self, start, count, buf):
+        """
+        Computes count samples into buf using code generated for the
+        program, see glitch_codegen.
+        """
+        import glitch_codegen
+        glitch_codegen.render(self, start, count, buf)
+
+    def _interpret_(self, start, count, buf):
+        """
+        Computes count samples into buf using the interpreter.
+        """
+        cells = self.cells
+        sp = self.sp
+        program = [(DISPATCH[opcode], argument) \
+            for opcode, argument in self.code]
+        for i in range(count):
+            t = (start + i) & MAXINT
+            for operation, argument in program:
+                sp = operation(cells, sp, t, argument)
+            buf[i] = cells[sp] & 0xFF
+        self.sp = sp
+
+class Cycle(object):
+    def __init__(self, start, length):
+        """
+        A Cycle keeps the samples of a melody repeating every length
+        samples from t = start on, as they are computed from there. For
+        melodies that are not stateless, the stack at every block
+        boundary among them is kept as well, see Melody._find_cycle_.
+        """
+        self.start = start
+        self.length = length
+        self.samples = bytearray(length)
+        self.filled = 0  # samples kept, from the beginning of the cycle
+        self.stacks = {}  # offset in the cycle: (cells, sp) before it
+
+    def _get_complete_(self):
+        return self.filled == self.length
+
+    complete = property(_get_complete_)
+
+    def phase(self, t):
+        """
+        Returns the offset of t (at least start) in the cycle.
+        """
+        return (t - self.start) % self.length
+
+    def remaining(self, t):
+        """
+        Returns how many samples from t (at least start) on complete the
+        cycle, once computed and kept.
+        """
+        return (self.filled - self.phase(t)) % self.length + \
+            self.length - self.filled
+
+    def keep(self, t, samples):
+        """
+        Keeps samples computed from t on, as far as they continue those
+        kept already.
+        """
+        if (t < self.start) or self.complete:
+            return
+        i = (self.filled - self.phase(t)) % self.length
+        if i < len(samples):
+            n = min(len(samples) - i, self.length - self.filled)
+            self.samples[self.filled:self.filled+n] = samples[i:i+n]
+            self.filled += n
+            if self.complete:  # repeated, so short cycles copy quickly
+                self.samples *= -(-BLOCKSIZE // self.length)
+
+    def copy(self, t, count, buf):
+        """
+        Copies count samples from t (at least start) of a complete cycle
+        into buf.
+        """
+        view = memoryview(buf)
+        samples = memoryview(self.samples)
+        offset = 0
+        while offset < count:
+            phase = self.phase(t + offset)
+            n = min(count - offset, len(samples) - phase)
+            view[offset:offset+n] = samples[phase:phase+n]
+            offset += n
+
+def parse(glitch, strict=False):
+    """
+    Splits a glitch into its title and lines in a single pass, checking
+    it against the grammar in FORMAT-draft-erlehmann 2. Returns the lines
+    (the title first) and a list of warnings, each a (line, column,
+    reason) tuple counting the title as line 0.
+
+    If strict is true, any problem raises a GlitchError listing all of
+    them; glitches too long to be valid are refused without looking at
+    them. Otherwise, titles and lines longer than LINE_MAX characters
+    are truncated or split, and only characters that can not be
+    interpreted raise a GlitchError.
+    """
+    if not isinstance(glitch, str):
+        raise TypeError('glitch must be str, not %s' % type(glitch).__name__)
+    if strict and (len(glitch) > GLITCH_MAX):
+        raise GlitchError([(0, 0, 'more than %d characters' % GLITCH_MAX)])
+    if glitch.endswith('\n'):
+        glitch = glitch[:-1]
+
+    warnings = []
+    errors = []
+    lines = glitch.split('!')
+
+    title = lines[0]
+    for column, char in enumerate(title):
+        if char not in TITLE_CHARACTERS:
+            warnings.append((0, column, '%r not allowed in title' % char))
+    if len(title) > LINE_MAX:
+        warnings.append((0, LINE_MAX, 'title longer than %d characters' % \
+            LINE_MAX))
+    if len(lines) == 1:
+        warnings.append((0, len(title), 'no instructions'))
+    elif len(lines) > LINES_MAX + 1:
+        warnings.append((LINES_MAX + 1, 0, 'more than %d lines' % LINES_MAX))
+
+    result = [title[:LINE_MAX]]
+    for row in range(1, len(lines)):
+        line = lines[row]
+        digits = 0
+        for column, char in enumerate(line):
+            if char in HEXDIGITS:
+                digits += 1
+                if digits == NUMBER_MAX + 1:
+                    warnings.append((row, column - NUMBER_MAX,
+                        'number longer than %d digits' % NUMBER_MAX))
+            else:
+                digits = 0
+                if char not in CHARACTERS:
+                    errors.append((row, column, '%r not allowed' % char))
+        if not line:
+            warnings.append((row, 0, 'empty line'))
+        elif len(line) > LINE_MAX:
+            warnings.append((row, LINE_MAX, 'line longer than %d characters' % \
+                LINE_MAX))
+            result.extend(_split_line_(line))
+            continue
+        result.append(line)
+
+    warnings.sort()
+    if errors or (strict and warnings):
+        raise GlitchError(sorted(errors + warnings))
+    return result, warnings
+
+def _split_line_(line):
+    """
+    Splits a line into lines of at most LINE_MAX characters, between
+    tokens so its meaning stays the same. Numbers longer than a line are
+    not split.
+    """
+    lines = []
+    while len(line) > LINE_MAX:
+        end = LINE_MAX
+        while (end > 0) and (line[end - 1] in HEXDIGITS) and \
+            (line[end] in HEXDIGITS):
+            end -= 1
+        if end == 0:
+            while (end < len(line)) and (line[end] in HEXDIGITS):
+                end += 1
+        lines.append(line[:end])
+        line = line[end:]
+    if line:
+        lines.append(line)
+    return lines
+
+def _tokenize_line_(row, line):
+    """
+    Returns the tokens of line row and their (row, column) positions.
+    Numbers never continue across lines, so lines are tokenized alone.
+    """
+    tokens = []
+    positions = []
+
+    STATE_NUMBER = False
+
+    for j, char in enumerate(line):
+        if (char in HEXDIGITS) and STATE_NUMBER:
+            tokens[-1] += char
+        elif (char != '.'):
+            tokens.append(char)
+            positions.append((row, j))
+
+        if (char in HEXDIGITS):
+            STATE_NUMBER = True
+        else:
+            STATE_NUMBER = False
+
+    return tokens, positions
+
+def _translate_(tokens, positions):
+    """
+    Returns the (opcode, argument) pairs for tokens and the positions of
+    the tokens they came from; see Melody._compile_.
+    """
+    program = []
+    origins = []
+    for token, position in zip(tokens, positions):
+        if not token in OPCODES:  # not an opcode, must be a number
+            program.append((OP_NUMBER, int(token, 16)))
+        elif token in OPCODE_NUMBERS:
+            program.append((OPCODE_NUMBERS[token], None))
+        else:
+            continue
+        origins.append(position)
+    return program, origins
+
+def _op_number(cells, sp, t, number):
+    sp = (sp + 1) & 0xFF
+    cells[sp] = number
+    return sp
+
+def _op_t(cells, sp, t, argument):
+    sp = (sp + 1) & 0xFF
+    cells[sp] = t
+    return sp
+
+def _op_put(cells, sp, t, argument):
+    cells[sp - (cells[sp] & 0xFF)] = cells[sp - 1]
+    return (sp - 1) & 0xFF
+
+def _op_drop(cells, sp, t, argument):
+    return (sp - 1) & 0xFF
+
+# Binary operations pop a and b, but leave b behind in the cell that held a;
+# this is what rotating the original deque did and must be kept, as stale
+# cells can be read back through OP_PICK or after wrapping around the ring.
+
+def _op_mul(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    cells[sp - 1] = (b * a) & MAXINT
+    return (sp - 1) & 0xFF
+
+def _op_div(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    if a:
+        cells[sp - 1] = (b // a) & MAXINT
+    else:
+        cells[sp - 1] = 0
+    return (sp - 1) & 0xFF
+
+def _op_add(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    cells[sp - 1] = (b + a) & MAXINT
+    return (sp - 1) & 0xFF
+
+def _op_sub(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    cells[sp - 1] = (b - a) & MAXINT
+    return (sp - 1) & 0xFF
+
+def _op_mod(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    if a:
+        cells[sp - 1] = (b % a) & MAXINT
+    else:
+        cells[sp - 1] = 0
+    return (sp - 1) & 0xFF
+
+def _op_lshift(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    if a < 32:
+        cells[sp - 1] = (b << a) & MAXINT
+    else:
+        cells[sp - 1] = 0
+    return (sp - 1) & 0xFF
+
+def _op_rshift(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    if a < 32:
+        cells[sp - 1] = (b >> a) & MAXINT
+    else:
+        cells[sp - 1] = 0
+    return (sp - 1) & 0xFF
+
+def _op_and(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    cells[sp - 1] = (b & a) & MAXINT
+    return (sp - 1) & 0xFF
+
+def _op_or(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    cells[sp - 1] = (b | a) & MAXINT
+    return (sp - 1) & 0xFF
+
+def _op_xor(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    cells[sp - 1] = (b ^ a) & MAXINT
+    return (sp - 1) & 0xFF
+
+def _op_not(cells, sp, t, argument):
+    cells[sp] = (~cells[sp] & MAXINT)
+    return sp
+
+def _op_dup(cells, sp, t, argument):
+    cells[(sp + 1) & 0xFF] = cells[sp]
+    return (sp + 1) & 0xFF
+
+def _op_pick(cells, sp, t, argument):
+    # 0 OP_PICK is equivalent to OP_DUP
+    # 0xFF OP_PICK is equivalent to 0xFF
+    cells[sp] = cells[(sp - 1 - cells[sp]) & 0xFF]
+    return sp
+
+def _op_swap(cells, sp, t, argument):
+    cells[sp], cells[sp - 1] = cells[sp - 1], cells[sp]
+    return sp
+
+def _op_lt(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    if (b < a):
+        cells[sp - 1] = MAXINT
+    else:
+        cells[sp - 1] = 0
+    return (sp - 1) & 0xFF
+
+def _op_gt(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    if (b > a):
+        cells[sp - 1] = MAXINT
+    else:
+        cells[sp - 1] = 0
+    return (sp - 1) & 0xFF
+
+def _op_eq(cells, sp, t, argument):
+    a = cells[sp]
+    b = cells[sp] = cells[sp - 1]
+    if (b == a):
+        cells[sp - 1] = MAXINT
+    else:
+        cells[sp - 1] = 0
+    return (sp - 1) & 0xFF
+
+def _op_constants(cells, sp, t, argument):
+    # writes constants to cells relative to the top-of-stack pointer
+    writes, delta = argument
+    for offset, value in writes:
+        cells[(sp + offset) & 0xFF] = value
+    return (sp + delta) & 0xFF
+
+def _op_binary_constant(cells, sp, t, argument):
+    # a number followed by a binary operation
+    operator, a, opcode = argument
+    b = cells[(sp + 1) & 0xFF] = cells[sp]
+    cells[sp] = operator(b, a)
+    return sp
+
+def _op_t_binary_constant(cells, sp, t, argument):
+    # OP_T, a number and a binary operation
+    operator, a, opcode = argument
+    cells[(sp + 2) & 0xFF] = t
+    sp = (sp + 1) & 0xFF
+    cells[sp] = operator(t, a)
+    return sp
+
+DISPATCH = [
+    _op_number, _op_t, _op_put, _op_drop, _op_mul, _op_div, _op_add,
+    _op_sub, _op_mod, _op_lshift, _op_rshift, _op_and, _op_or, _op_xor,
+    _op_not, _op_dup, _op_pick, _op_swap, _op_lt, _op_gt, _op_eq,
+    _op_constants, _op_binary_constant, _op_t_binary_constant
+]
+
+# the expression standing for the value of t in analyzed programs
+T = (OP_T,)
+
+def _fold_(opcode, *operands):
+    """
+    Applies an operation to constant operands.
+    """
+    cells = list(operands)
+    sp = DISPATCH[opcode](cells, len(cells) - 1, 0, None)
+    return cells[sp]
+
+def _analyze_(program):
+    """
+    Executes one pass of program on a stack of unknown cells, recording
+    every cell value as an expression over t: T, an integer constant or
+    a tuple of an opcode and its operand expressions (b before a).
+
+    A program is stateless if it never reads a cell it has not written
+    in the same pass and its OP_PUT / OP_PICK indices are constant.
+    Its samples then depend on t alone. Returns (expression, delta),
+    where expression yields the sample (or is None for a program that
+    is not stateless) and delta is the change of the top-of-stack
+    pointer per pass, which is the same for every program pass.
+    """
+    delta = sum([STACK_EFFECTS[opcode] for opcode, argument in program]) & 0xFF
+
+    cells = {}
+    sp = 0
+    for opcode, argument in program:
+        try:
+            if opcode == OP_NUMBER:
+                sp = (sp + 1) & 0xFF
+                cells[sp] = argument
+            elif opcode == OP_T:
+                sp = (sp + 1) & 0xFF
+                cells[sp] = T
+            elif opcode == OP_PUT:
+                a = cells[sp]
+                if not isinstance(a, int):
+                    raise KeyError(sp)
+                cells[(sp - (a & 0xFF)) & 0xFF] = cells[(sp - 1) & 0xFF]
+                sp = (sp - 1) & 0xFF
+            elif opcode == OP_DROP:
+                sp = (sp - 1) & 0xFF
+            elif opcode == OP_NOT:
+                a = cells[sp]
+                if isinstance(a, int):
+                    cells[sp] = _fold_(opcode, a)
                 else:
-                    stack.append(0)
-
-            elif (token == 't'):  # OP_GT
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                if (b > a):
-                    stack.append(MAXINT)
+                    cells[sp] = (opcode, a)
+            elif opcode == OP_DUP:
+                cells[(sp + 1) & 0xFF] = cells[sp]
+                sp = (sp + 1) & 0xFF
+            elif opcode == OP_PICK:
+                a = cells[sp]
+                if not isinstance(a, int):
+                    raise KeyError(sp)
+                cells[sp] = cells[(sp - 1 - a) & 0xFF]
+            elif opcode == OP_SWAP:
+                cells[sp], cells[(sp - 1) & 0xFF] = \
+                    cells[(sp - 1) & 0xFF], cells[sp]
+            else:  # binary operation
+                a = cells[sp]
+                b = cells[sp] = cells[(sp - 1) & 0xFF]
+                sp = (sp - 1) & 0xFF
+                if isinstance(a, int) and isinstance(b, int):
+                    cells[sp] = _fold_(opcode, b, a)
                 else:
-                    stack.append(0)
-
-            elif (token == 'u'):  # OP_EQ
-                a = stack.pop()
-                b = stack[-1]
-                stack.rotate(1)
-                if (b == a):
-                    stack.append(MAXINT)
+                    cells[sp] = (opcode, b, a)
+        except KeyError:  # unknown cell, left over from a previous pass
+            return None, delta
+
+    return cells.get(sp), delta
+
+# change of the top-of-stack pointer caused by each opcode
+STACK_EFFECTS = [1, 1, -1, -1] + [-1] * 10 + [0, 1, 0, 0, -1, -1, -1]
+
+# a cell value that does not depend on the stack before a pass, but is
+# not constant either
+VARIABLE = 'VARIABLE'
+
+# passes analyzed at most by _memory_
+MEMORY_MAX = 1024
+
+def _memory_(program):
+    """
+    Finds how many passes it takes a program to forget its stack.
+
+    Starting from a stack of unknown cells, passes are executed on cells
+    that are None (unknown), VARIABLE or a constant. Returns the number
+    of passes after which every sample is independent of the stack that
+    preceded them, so that rendering that many passes from any stack
+    leaves a stack producing the true samples. Returns None for programs
+    that never forget (feedback, or OP_PUT / OP_PICK with a variable
+    index).
+
+    As less and less cells are unknown with each pass, the cells viewed
+    from the top-of-stack pointer must eventually stop changing; from
+    then on every pass produces the same kind of sample.
+    """
+    cells = [None] * 256
+    sp = 0
+    previous = None
+    forgotten = 0
+    for passes in range(MEMORY_MAX):
+        for opcode, argument in program:
+            if opcode == OP_NUMBER:
+                sp = (sp + 1) & 0xFF
+                cells[sp] = argument
+            elif opcode == OP_T:
+                sp = (sp + 1) & 0xFF
+                cells[sp] = VARIABLE
+            elif opcode == OP_PUT:
+                a = cells[sp]
+                if not isinstance(a, int):
+                    return None
+                cells[(sp - (a & 0xFF)) & 0xFF] = cells[sp - 1]
+                sp = (sp - 1) & 0xFF
+            elif opcode == OP_DROP:
+                sp = (sp - 1) & 0xFF
+            elif opcode == OP_NOT:
+                a = cells[sp]
+                if isinstance(a, int):
+                    cells[sp] = _fold_(opcode, a)
+            elif opcode == OP_DUP:
+                cells[(sp + 1) & 0xFF] = cells[sp]
+                sp = (sp + 1) & 0xFF
+            elif opcode == OP_PICK:
+                a = cells[sp]
+                if not isinstance(a, int):
+                    return None
+                cells[sp] = cells[(sp - 1 - a) & 0xFF]
+            elif opcode == OP_SWAP:
+                cells[sp], cells[sp - 1] = cells[sp - 1], cells[sp]
+            else:  # binary operation
+                a = cells[sp]
+                b = cells[sp] = cells[sp - 1]
+                sp = (sp - 1) & 0xFF
+                if a is None or b is None:
+                    cells[sp] = None
+                elif isinstance(a, int) and isinstance(b, int):
+                    cells[sp] = _fold_(opcode, b, a)
                 else:
-                    stack.append(0)
+                    cells[sp] = VARIABLE
 
-        result = stack[-1]
-        return result & 0xFF
+        if cells[sp] is None:
+            forgotten = passes + 1
+
+        current = cells[sp+1:] + cells[:sp+1]
+        if current == previous:
+            if cells[sp] is None:
+                return None
+            return forgotten
+        previous = current
+
+    return None
+
+def _demand_(expression, demanded, demands):
+    """
+    Records in demands (id of an expression: bits) which bits of the
+    values of expression and its operands the demanded bits of its value
+    depend on; for t, they are found at id(T). Cells of an earlier pass
+    (('cell', offset), see _effect_) do not depend on t.
+    """
+    if isinstance(expression, int) or not demanded:
+        return
+    known = demands.get(id(expression), 0)
+    if demanded | known == known:
+        return
+    demanded = demands[id(expression)] = demanded | known
+
+    opcode = expression[0]
+    if opcode in (OP_T, 'cell'):
+        return
+    if opcode == OP_NOT:
+        _demand_(expression[1], demanded, demands)
+        return
+
+    b, a = expression[1:]
+    below = (1 << demanded.bit_length()) - 1  # carries only go upwards
+    if opcode in (OP_MUL, OP_ADD, OP_SUB):
+        needs = below, below
+    elif opcode == OP_XOR:
+        needs = demanded, demanded
+    elif opcode == OP_AND:
+        needs = (demanded & a if isinstance(a, int) else demanded,
+            demanded & b if isinstance(b, int) else demanded)
+    elif opcode == OP_OR:
+        needs = (demanded & ~a if isinstance(a, int) else demanded,
+            demanded & ~b if isinstance(b, int) else demanded)
+    elif (opcode == OP_LSHIFT) and isinstance(a, int):
+        needs = (demanded >> a if a < 32 else 0), 0
+    elif (opcode == OP_RSHIFT) and isinstance(a, int):
+        needs = ((demanded << a) & MAXINT if a < 32 else 0), 0
+    elif (opcode in (OP_DIV, OP_MOD)) and isinstance(a, int) and \
+        not a & (a - 1):  # zero or a power of two
+        if a == 0:
+            needs = 0, 0
+        elif opcode == OP_DIV:
+            needs = (demanded << (a.bit_length() - 1)) & MAXINT, 0
+        else:
+            needs = demanded & (a - 1), 0
+    else:  # comparisons, and the rest of division and shifts
+        needs = MAXINT, MAXINT
+    _demand_(b, needs[0], demands)
+    _demand_(a, needs[1], demands)
+
+def _period_(expression):
+    """
+    Returns the number of samples after which the samples of a stateless
+    program repeat, given its expression (see _analyze_): a power of two,
+    as they only depend on that many low bits of t.
+    """
+    demands = {}
+    _demand_(expression, 0xFF, demands)
+    return 1 << demands.get(id(T), 0).bit_length()
+
+def _cycle_mask_(program):
+    """
+    Returns a mask of the low bits of t a pass of program depends on,
+    besides the stack: passes at t and t' on equal stacks leave equal
+    stacks (and samples) if t and t' agree in those bits, and so do all
+    passes after them.
+
+    Every cell a pass writes (see _effect_) is part of the stack, so all
+    bits of its value are demanded. OP_PUT / OP_PICK with a variable
+    index may touch any cell, so such programs depend on all bits.
+    """
+    effect = _effect_(program)
+    if effect is None:
+        return MAXINT
+    demands = {}
+    for value in effect[0].values():
+        _demand_(value, MAXINT, demands)
+    return (1 << demands.get(id(T), 0).bit_length()) - 1
+
+_vectorizer = None
+_unvectorized = 0  # samples asked for before importing the NumPy backend
+
+def _load_vectorizer_(count):
+    """
+    Imports the NumPy backend when count more samples are asked for and
+    it pays off, see VECTORIZE_IMPORT_MIN; right away if NumPy has been
+    imported already. Returns False if NumPy is not (yet) available.
+    """
+    global _vectorizer, _unvectorized
+    if _vectorizer is None:
+        _unvectorized += count
+        if (_unvectorized < VECTORIZE_IMPORT_MIN) and ('numpy' not in modules):
+            return False
+        try:
+            import glitch_numpy
+            _vectorizer = glitch_numpy
+        except ImportError:
+            _vectorizer = False
+    return _vectorizer is not False
+
+def _render_chunk_(arguments):
+    """
+    Renders a chunk of samples in a worker process, first rendering the
+    given number of warmup samples preceding it.
+    """
+    tokens, cells, sp, warmup, start, count = arguments
+    m = Melody('')
+    m.tokens = tokens
+    m.cells = cells
+    m.sp = sp
+    m._render_(start - warmup, warmup, bytearray(warmup))
+    return m.render(start, count)
 
+def render_parallel(melody, start, count, jobs=None):
+    """
+    Computes count samples of melody beginning at t = start, using a pool
+    of jobs processes (by default one per CPU), and returns them as bytes.
+    The result is identical to melody.render(start, count), but the stack
+    of melody is left unchanged.
+
+    The range of t is split into chunks. Chunks after the first begin
+    with the melody.memory samples preceding them, so their stack is
+    equivalent to the one the melody would have there. Melodies that
+    never forget their stack, and fewer than PARALLEL_MIN samples, are
+    rendered in this process.
+    """
+    from os import cpu_count
+
+    memory = melody.memory
+    jobs = jobs or cpu_count() or 1
+    if (memory is None) or (jobs == 1) or (count < PARALLEL_MIN):
+        m = Melody('')
+        m.tokens = melody.tokens
+        m.cells = list(melody.cells)
+        m.sp = melody.sp
+        return m.render(start, count)
+
+    chunksize = max(-(-count // (jobs * 4)), memory, VECTORIZE_MIN)
+    chunks = []
+    for offset in range(0, count, chunksize):
+        if offset == 0:
+            cells, warmup = list(melody.cells), 0
+        else:  # any stack will do, as it is forgotten during warmup
+            cells, warmup = [0] * 256, memory
+        sp = (melody.sp + (offset - warmup) * melody.delta) & 0xFF
+        chunks.append((melody.tokens, cells, sp, warmup, start + offset,
+            min(chunksize, count - offset)))
+
+    if melody.expression is not None:
+        _load_vectorizer_(count)  # once here, not in every process
+
+    from multiprocessing import Pool
+
+    pool = Pool(jobs)
+    try:
+        return b''.join(pool.map(_render_chunk_, chunks))
+    finally:
+        pool.close()
+        pool.join()
+
+def wav_header(count=None, rate=SAMPLERATE, bits=8):
+    """
+    Returns a RIFF WAVE header for count mono samples, unsigned 8-bit or
+    signed 16-bit. If count is None, the header claims the largest
+    possible size, as is usual for streams of unknown length; it can be
+    replaced later.
+    """
+    width = bits // 8
+    if count is None:
+        size = (MAXINT - 36) // width * width
+    else:
+        size = count * width
+    return b'RIFF' + pack('<I', size + 36) + b'WAVE' + \
+        b'fmt ' + pack('<IHHIIHH', 16, 1, 1, rate, rate * width, width,
+            bits) + \
+        b'data' + pack('<I', size)
+
+def _render_file_(arguments):
+    """
+    Renders the beginning of a glitch file into an output file in a
+    worker process.
+    """
+    inpath, outpath, count, format, rate = arguments
+    with open(inpath) as f:
+        m = Melody(f.read().replace('\n', ''))
+    with open(outpath, 'wb') as f:
+        if format == 'wav':
+            f.write(wav_header(count, rate))
+        buf = bytearray(BLOCKSIZE)
+        for offset in range(0, count, BLOCKSIZE):
+            n = min(BLOCKSIZE, count - offset)
+            f.write(memoryview(m.render(offset, n, buf))[:n])
+    return outpath
+
+def render_batch(files, count, jobs=None, format='raw', rate=SAMPLERATE):
+    """
+    Renders the first count samples of several glitch files in parallel,
+    one process per file at a time. files is a list of (input path,
+    output path) pairs; returns the list of output paths. format is
+    'raw' for bare samples or 'wav' for WAVE files of the given rate.
+    """
+    from multiprocessing import Pool
+
+    pool = Pool(jobs)
+    try:
+        return pool.map(_render_file_,
+            [(inpath, outpath, count, format, rate) \
+                for inpath, outpath in files])
+    finally:
+        pool.close()
+        pool.join()
+
+# operators computing binary operations from b and a, for superinstructions
+OPERATORS = {
+    OP_MUL: lambda b, a: (b * a) & MAXINT,
+    OP_DIV: lambda b, a: (b // a) & MAXINT if a else 0,
+    OP_ADD: lambda b, a: (b + a) & MAXINT,
+    OP_SUB: lambda b, a: (b - a) & MAXINT,
+    OP_MOD: lambda b, a: (b % a) & MAXINT if a else 0,
+    OP_LSHIFT: lambda b, a: (b << a) & MAXINT if a < 32 else 0,
+    OP_RSHIFT: lambda b, a: (b >> a) & MAXINT if a < 32 else 0,
+    OP_AND: lambda b, a: (b & a) & MAXINT,
+    OP_OR: lambda b, a: (b | a) & MAXINT,
+    OP_XOR: lambda b, a: (b ^ a) & MAXINT,
+    OP_LT: lambda b, a: MAXINT if b < a else 0,
+    OP_GT: lambda b, a: MAXINT if b > a else 0,
+    OP_EQ: lambda b, a: MAXINT if b == a else 0
+}
+
+def _effect_(code):
+    """
+    Executes code once on a stack of symbolic cells, a cell at offset k
+    from the top-of-stack pointer initially holding ('cell', k). Returns
+    (cells, delta): a dict of the cells written, keyed by offset, holding
+    expressions as in _analyze_, and the change of the top-of-stack
+    pointer. Returns None if an OP_PUT or OP_PICK index is not constant.
+
+    Two pieces of code with equal effects change every one of the 256
+    cells in the same way, so either can replace the other.
+    """
+    cells = {}
+    sp = 0
+
+    def get(offset):
+        offset = offset & 0xFF
+        try:
+            return cells[offset]
+        except KeyError:
+            return ('cell', offset)
+
+    def set(offset, value):
+        cells[offset & 0xFF] = value
+
+    def binary(opcode, b, a):
+        if isinstance(a, int) and isinstance(b, int):
+            return _fold_(opcode, b, a)
+        return (opcode, b, a)
+
+    for opcode, argument in code:
+        if opcode == OP_NUMBER:
+            sp += 1
+            set(sp, argument)
+        elif opcode == OP_T:
+            sp += 1
+            set(sp, T)
+        elif opcode == OP_PUT:
+            a = get(sp)
+            if not isinstance(a, int):
+                return None
+            set(sp - (a & 0xFF), get(sp - 1))
+            sp -= 1
+        elif opcode == OP_DROP:
+            sp -= 1
+        elif opcode == OP_NOT:
+            a = get(sp)
+            if isinstance(a, int):
+                set(sp, _fold_(opcode, a))
+            elif a[0] == OP_NOT:  # inverting twice changes nothing
+                set(sp, a[1])
+            else:
+                set(sp, (opcode, a))
+        elif opcode == OP_DUP:
+            set(sp + 1, get(sp))
+            sp += 1
+        elif opcode == OP_PICK:
+            a = get(sp)
+            if not isinstance(a, int):
+                return None
+            set(sp, get(sp - 1 - a))
+        elif opcode == OP_SWAP:
+            a, b = get(sp), get(sp - 1)
+            set(sp, b)
+            set(sp - 1, a)
+        elif opcode == OP_CONSTANTS:
+            writes, delta = argument
+            for offset, value in writes:
+                set(sp + offset, value)
+            sp += delta
+        elif opcode == OP_BINARY_CONSTANT:
+            operator, a, binopcode = argument
+            b = get(sp)
+            set(sp + 1, b)
+            set(sp, binary(binopcode, b, a))
+        elif opcode == OP_T_BINARY_CONSTANT:
+            operator, a, binopcode = argument
+            set(sp + 2, T)
+            sp += 1
+            set(sp, binary(binopcode, T, a))
+        else:  # binary operation
+            a = get(sp)
+            b = get(sp - 1)
+            set(sp, b)
+            sp -= 1
+            set(sp, binary(opcode, b, a))
+
+    for offset in list(cells.keys()):
+        if cells[offset] == ('cell', offset):  # unchanged
+            del cells[offset]
+    return cells, sp & 0xFF
+
+def _constant_(effect):
+    """
+    Checks that an effect only writes constants.
+    """
+    if effect is None:
+        return False
+    for value in effect[0].values():
+        if not isinstance(value, int):
+            return False
+    return True
+
+def _optimize_(program):
+    """
+    Rewrites a program into faster code with the same effect (see
+    _effect_) on all 256 cells, not only the top of stack, as the stack
+    carries over between passes. Every rewrite is checked by comparing
+    the effects of the original and the replacement.
+
+    Instructions only producing constants are folded into a single
+    OP_CONSTANTS, sequences without effect (like two OP_SWAP) are
+    removed, and a number followed by a binary operation (optionally
+    preceded by OP_T) becomes a superinstruction. Reserved opcodes are
+    already dropped by Melody._compile_.
+    """
+    code = list(program)
+
+    changed = True
+    while changed:
+        changed = False
+
+        # constant folding
+        result = []
+        i = 0
+        while i < len(code):
+            end = i
+            for j in range(i + 1, len(code) + 1):
+                if not _constant_(_effect_(code[i:j])):
+                    break
+                end = j
+            if end - i >= 2:
+                cells, delta = _effect_(code[i:end])
+                writes = tuple(sorted(
+                    [(((offset + 128) & 0xFF) - 128, value) \
+                        for offset, value in cells.items()]))
+                if delta > 128:
+                    delta -= 256
+                replacement = (OP_CONSTANTS, (writes, delta))
+                if _effect_([replacement]) == _effect_(code[i:end]):
+                    result.append(replacement)
+                    i = end
+                    changed = True
+                    continue
+            result.append(code[i])
+            i += 1
+        code = result
+
+        # removal of sequences without effect
+        result = []
+        i = 0
+        while i < len(code):
+            for j in (i + 2, i + 3):
+                if (j <= len(code)) and (_effect_(code[i:j]) == ({}, 0)):
+                    i = j
+                    changed = True
+                    break
+            else:
+                result.append(code[i])
+                i += 1
+        code = result
+
+    # superinstructions
+    result = []
+    i = 0
+    while i < len(code):
+        for length in (3, 2):
+            window = code[i:i+length]
+            if len(window) < length:
+                continue
+            opcodes = [opcode for opcode, argument in window]
+            if opcodes[-2:-1] != [OP_NUMBER] or \
+                opcodes[-1] not in BINARY_OPCODES:
+                continue
+            a = window[-2][1]
+            binopcode = opcodes[-1]
+            argument = (OPERATORS[binopcode], a, binopcode)
+            if length == 3:
+                if opcodes[0] != OP_T:
+                    continue
+                replacement = (OP_T_BINARY_CONSTANT, argument)
+            else:
+                replacement = (OP_BINARY_CONSTANT, argument)
+            if _effect_([replacement]) == _effect_(window):
+                result.append(replacement)
+                i += length
+                break
+        else:
+            result.append(code[i])
+            i += 1
+    return result
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Keeps rendered samples on disk, so melodies played again are read
+# instead of computed. Samples are kept in blocks of BLOCKSIZE, counting
+# from t = 0 after a reset, one file per block. Files are named by a hash
+# of the instructions of the melody (see normalize), VERSION and the index
+# of the block; they are written once and mapped into memory to be read.
+#
+# A file holds a header (magic, VERSION, number of samples and a CRC-32
+# of the rest), the samples and, for melodies that are not stateless, the
+# stack after them, so computing can continue from the end of the block.
+
+from collections import OrderedDict
+from hashlib import sha1
+from mmap import mmap, ACCESS_READ
+from os import environ, getpid, makedirs, path, replace, scandir, unlink, \
+    utime
+from struct import Struct
+from zlib import crc32
+
+from glitch import BLOCKSIZE, MAXINT, OP_NUMBER, OPCODE_NUMBERS
+
+# changes whenever samples computed for a melody might change, so files
+# written before are not used any more
+VERSION = 1
+
+DIRECTORY = path.join(environ.get('XDG_CACHE_HOME') or \
+    path.expanduser(path.join('~', '.cache')), 'libglitch')
+SIZE_MAX = 256 << 20  # bytes of files kept, least recently used removed
+
+MAPS_MAX = 16  # files kept mapped into memory
+PENDING_MAX = 8  # blocks being computed in parts at once
+
+MAGIC = b'GLCH'
+HEADER = Struct('<4sIII')
+STACK = Struct('<256IB')  # cells and top-of-stack pointer
+
+OPCODE_CHARACTERS = dict([(opcode, character) \
+    for character, opcode in OPCODE_NUMBERS.items()])
+
+def normalize(melody):
+    """
+    Returns the instructions of melody as text, without what does not
+    change its samples: the title, NOPs, reserved opcodes, muted lines,
+    line breaks and leading zeros.
+    """
+    instructions = []
+    for opcode, argument in melody.program:
+        if opcode == OP_NUMBER:
+            instructions.append('%X' % argument)
+        else:
+            instructions.append(OPCODE_CHARACTERS[opcode])
+    return '.'.join(instructions)
+
+class Cache(object):
+    def __init__(self, directory=DIRECTORY, size_max=SIZE_MAX):
+        """
+        A Cache keeps samples of melodies in files in directory. Once
+        these take more than size_max bytes, the least recently used
+        ones are removed. Files are checked when they are opened; those
+        not matching their CRC are removed, too.
+        """
+        makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.size_max = size_max
+        self.maps = OrderedDict()  # key: mmap of a valid file
+        # key: [samples, count] of blocks computed from their beginning,
+        # until they are complete
+        self.pending = OrderedDict()
+
+    def render(self, melody, start, count, out=None):
+        """
+        Computes count samples of melody beginning at t = start, like
+        melody.render, reading the samples of blocks found in files and
+        writing those of blocks computed completely.
+
+        Files are used if the stack of melody does not matter (for
+        stateless melodies) or is that of a reset melody having computed
+        every sample before start; for other melodies only up to the end
+        of a block, where the stack is known.
+
+        If out is None and the samples lie in a single file, a memoryview
+        of the mapped file is returned, without copying them.
+        """
+        if (out is None) and (count > 0) and \
+            (start // BLOCKSIZE == (start + count - 1) // BLOCKSIZE):
+            samples = self._read_(melody, start, count)
+            if samples is not None:
+                return samples
+
+        buf = bytearray(count) if out is None else out
+        view = memoryview(buf)
+        offset = 0
+        while offset < count:
+            t = start + offset
+            n = min(count - offset, BLOCKSIZE - t % BLOCKSIZE)
+            samples = self._read_(melody, t, n)
+            if samples is None:
+                stateless = melody.expression is not None
+                known = stateless or (melody.t == t)
+                melody.render(t, n, view[offset:offset+n])
+                if known:
+                    self._keep_(melody, t, view[offset:offset+n], stateless)
+            else:
+                view[offset:offset+n] = samples
+            offset += n
+
+        if out is None:
+            return bytes(buf)
+        return out
+
+    def _key_(self, melody, index):
+        text = '%d!%s!%d' % (VERSION, normalize(melody), index)
+        return sha1(text.encode('ascii')).hexdigest()
+
+    def _read_(self, melody, t, count):
+        """
+        Returns a memoryview of count samples from t in a file, and brings
+        melody past them, or returns None if there is no file to use.
+        """
+        stateless = melody.expression is not None
+        if not (stateless or ((melody.t == t) and \
+            ((t + count) % BLOCKSIZE == 0))):
+            return None
+        mapped = self._open_(self._key_(melody, t // BLOCKSIZE))
+        if mapped is None:
+            return None
+
+        if stateless:
+            melody.skip(t, count)
+        elif len(mapped) < HEADER.size + BLOCKSIZE + STACK.size:
+            return None
+        else:
+            stack = STACK.unpack_from(mapped, HEADER.size + BLOCKSIZE)
+            melody.cells = list(stack[:256])
+            melody.sp = stack[256]
+            melody.t = t + count
+        offset = HEADER.size + t % BLOCKSIZE
+        return memoryview(mapped)[offset:offset+count]
+
+    def _open_(self, key):
+        """
+        Returns the file of key mapped into memory, or None if there is
+        no valid one.
+        """
+        mapped = self.maps.pop(key, None)
+        if mapped is None:
+            filename = path.join(self.directory, key)
+            try:
+                with open(filename, 'rb') as f:
+                    mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+            except (IOError, OSError, ValueError):  # missing or empty
+                return None
+            if not _valid_(mapped):
+                mapped.close()
+                try:
+                    unlink(filename)
+                except OSError:
+                    pass
+                return None
+            try:
+                utime(filename)  # used last, so removed last
+            except OSError:
+                pass
+        self.maps[key] = mapped
+        while len(self.maps) > MAPS_MAX:
+            self.maps.popitem(last=False)
+        return mapped
+
+    def _keep_(self, melody, t, samples, stateless):
+        """
+        Collects samples computed from t into their block and writes it
+        once it is complete; only blocks computed from their beginning
+        are kept, and only if the stack after them fits into 32 bits per
+        cell (numbers longer than 8 digits are pushed whole, and masking
+        them would change the samples computed from the stored stack).
+        """
+        key = self._key_(melody, t // BLOCKSIZE)
+        offset = t % BLOCKSIZE
+        if offset == 0:
+            self.pending.pop(key, None)
+            self.pending[key] = [bytearray(BLOCKSIZE), 0]
+            while len(self.pending) > PENDING_MAX:
+                self.pending.popitem(last=False)
+        entry = self.pending.get(key)
+        if (entry is None) or (entry[1] != offset):
+            return
+        entry[0][offset:offset+len(samples)] = samples
+        entry[1] += len(samples)
+        if entry[1] == BLOCKSIZE:
+            del self.pending[key]
+            if stateless:
+                self._write_(key, entry[0], b'')
+            elif max(melody.cells) <= MAXINT:
+                self._write_(key, entry[0],
+                    STACK.pack(*(melody.cells + [melody.sp])))
+
+    def _write_(self, key, samples, stack):
+        """
+        Writes a file, under another name first, so it is never seen
+        incomplete, then removes the least recently used files beyond
+        size_max.
+        """
+        filename = path.join(self.directory, key)
+        if path.exists(filename):
+            return
+        payload = bytes(samples) + stack
+        temporary = '%s.%d.tmp' % (filename, getpid())
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, BLOCKSIZE,
+                    crc32(payload)))
+                f.write(payload)
+            replace(temporary, filename)
+        except (IOError, OSError):
+            try:
+                unlink(temporary)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used files until the rest take no more
+        than size_max bytes.
+        """
+        files = []
+        size = 0
+        for entry in scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:  # removed meanwhile
+                continue
+            files.append((stat.st_mtime, entry.path, stat.st_size))
+            size += stat.st_size
+        files.sort()
+        for mtime, filename, filesize in files:
+            if size <= self.size_max:
+                break
+            try:
+                unlink(filename)
+            except OSError:
+                continue
+            size -= filesize
+
+def _valid_(mapped):
+    """
+    Returns whether a mapped file has a correct header and CRC.
+    """
+    if len(mapped) not in (HEADER.size + BLOCKSIZE,
+        HEADER.size + BLOCKSIZE + STACK.size):
+        return False
+    magic, version, count, crc = HEADER.unpack_from(mapped)
+    if (magic != MAGIC) or (version != VERSION) or (count != BLOCKSIZE):
+        return False
+    with memoryview(mapped) as view:
+        return crc32(view[HEADER.size:]) == crc
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Generates specialised Python code for the program of a melody. Cells are
+# held in local variables within a pass; only the cells a pass reads are
+# loaded and only its final writes are stored, as long as OP_PUT / OP_PICK
+# indices are constant. Variable indices make the code store all pending
+# writes first and load cells again afterwards.
+#
+# Values depending only on high bits of t (like t >> 16 & 3, the note of
+# a melody) are hoisted out of the loop over samples: t is split into
+# aligned runs over which those bits stay the same, and such values are
+# computed once per run, from the first t of the run.
+
+from collections import OrderedDict
+from itertools import count as counter
+
+from glitch import MAXINT, OP_NUMBER, OP_T, OP_PUT, OP_DROP, OP_MUL, \
+    OP_DIV, OP_ADD, OP_SUB, OP_MOD, OP_LSHIFT, OP_RSHIFT, OP_AND, OP_OR, \
+    OP_XOR, OP_NOT, OP_DUP, OP_PICK, OP_SWAP, OP_LT, OP_GT, OP_EQ, _fold_
+
+CACHE_MAX = 256  # generated functions kept, least recently used dropped
+_cache = OrderedDict()
+
+# values not depending on this many low bits of t (or more) are hoisted
+HOIST_BITS = 8
+
+TEMPLATE = """
+def render(cells, sp, start, count, buf):
+    for i, t in enumerate(range(start, start + count)):
+%(body)s
+    return sp
+"""
+
+TEMPLATE_HOISTED = """
+def render(cells, sp, start, count, buf):
+    end = start + count
+    t0 = start
+    while t0 < end:
+        stop = min(end, (t0 | %(mask)d) + 1)
+%(hoisted)s
+        for i, t in enumerate(range(t0, stop), t0 - start):
+%(body)s
+        t0 = stop
+    return sp
+"""
+
+# binary operations on b and a; a is substituted first so constant
+# operands can pick simpler code
+BINARY = {
+    OP_MUL: '(%(b)s * %(a)s) & 0xFFFFFFFF',
+    OP_DIV: '(%(b)s // %(a)s) & 0xFFFFFFFF if %(a)s else 0',
+    OP_ADD: '(%(b)s + %(a)s) & 0xFFFFFFFF',
+    OP_SUB: '(%(b)s - %(a)s) & 0xFFFFFFFF',
+    OP_MOD: '(%(b)s %% %(a)s) & 0xFFFFFFFF if %(a)s else 0',
+    OP_LSHIFT: '(%(b)s << %(a)s) & 0xFFFFFFFF if %(a)s < 32 else 0',
+    OP_RSHIFT: '(%(b)s >> %(a)s) & 0xFFFFFFFF if %(a)s < 32 else 0',
+    OP_AND: '(%(b)s & %(a)s) & 0xFFFFFFFF',
+    OP_OR: '(%(b)s | %(a)s) & 0xFFFFFFFF',
+    OP_XOR: '(%(b)s ^ %(a)s) & 0xFFFFFFFF',
+    OP_LT: '0xFFFFFFFF if %(b)s < %(a)s else 0',
+    OP_GT: '0xFFFFFFFF if %(b)s > %(a)s else 0',
+    OP_EQ: '0xFFFFFFFF if %(b)s == %(a)s else 0'
+}
+
+# the same, for a constant a known to be nonzero / smaller than 32
+BINARY_CONSTANT = {
+    OP_DIV: '(%(b)s // %(a)s) & 0xFFFFFFFF',
+    OP_MOD: '(%(b)s %% %(a)s) & 0xFFFFFFFF',
+    OP_LSHIFT: '(%(b)s << %(a)s) & 0xFFFFFFFF',
+    OP_RSHIFT: '(%(b)s >> %(a)s) & 0xFFFFFFFF'
+}
+
+def source(program, tops=False):
+    """
+    Returns the source of a function render(cells, sp, start, count, buf)
+    computing count samples from t = start (not wrapping around) into buf
+    and returning the new top-of-stack pointer. If tops is true, the low
+    32 bits of the top of stack are written instead of 8, see glitch_tap.
+    """
+    body = []
+    hoisted = []  # computed once per run of t, see HOIST_BITS
+    values = {}  # offset from sp: (name or literal, constant or None)
+    dirty = set()  # offsets written, but not stored yet
+    names = counter()
+    coarse = {}  # name: number of low bits of t it does not depend on
+
+    def cell(offset):
+        # negative list indices wrap around, so no masking is needed
+        offset = offset & 0xFF
+        if offset == 0:
+            return 'cells[sp]'
+        return 'cells[sp - %d]' % (256 - offset)
+
+    def get(offset):
+        offset = offset & 0xFF
+        if offset not in values:
+            values[offset] = assign(cell(offset))
+        return values[offset]
+
+    def put(offset, value):
+        values[offset & 0xFF] = value
+        dirty.add(offset & 0xFF)
+
+    def assign(expression, bits=0):
+        name = 'v%d' % next(names)
+        if bits >= HOIST_BITS:
+            coarse[name] = bits
+            hoisted.append('%s = %s' % (name, expression))
+        else:
+            body.append('%s = %s' % (name, expression))
+        return (name, None)
+
+    def bits(value):
+        if value[1] is not None:
+            return 32
+        return coarse.get(value[0], 0)  # t and cells: 0
+
+    def operand(value, bits):
+        # t is only read by hoisted code through high bits, which are the
+        # same for the whole run
+        if (value[0] == 't') and (bits >= HOIST_BITS):
+            return 't0'
+        return value[0]
+
+    def constant(value):
+        return (str(value), value)
+
+    def store():
+        for offset in sorted(dirty):
+            body.append('%s = %s' % (cell(offset), values[offset][0]))
+        dirty.clear()
+
+    sp = 0
+    for opcode, argument in program:
+        if opcode == OP_NUMBER:
+            sp += 1
+            put(sp, constant(argument))
+        elif opcode == OP_T:
+            sp += 1
+            put(sp, ('t', None))
+        elif opcode == OP_PUT:
+            a = get(sp)
+            b = get(sp - 1)
+            if a[1] is not None:
+                put(sp - (a[1] & 0xFF), b)
+            else:
+                store()
+                body.append('cells[(sp + %d - (%s & 0xFF)) & 0xFF] = %s' % \
+                    (sp, a[0], b[0]))
+                values.clear()  # any cell may have changed
+            sp -= 1
+        elif opcode == OP_DROP:
+            sp -= 1
+        elif opcode == OP_NOT:
+            a = get(sp)
+            if a[1] is not None:
+                put(sp, constant(_fold_(opcode, a[1])))
+            else:
+                n = bits(a)
+                put(sp, assign('~%s & 0xFFFFFFFF' % operand(a, n), n))
+        elif opcode == OP_DUP:
+            put(sp + 1, get(sp))
+            sp += 1
+        elif opcode == OP_PICK:
+            a = get(sp)
+            if a[1] is not None:
+                put(sp, get(sp - 1 - a[1]))
+            else:
+                store()
+                put(sp, assign('cells[(sp + %d - %s) & 0xFF]' % \
+                    (sp - 1, a[0])))
+        elif opcode == OP_SWAP:
+            a = get(sp)
+            b = get(sp - 1)
+            put(sp, b)
+            put(sp - 1, a)
+        else:  # binary operation
+            a = get(sp)
+            b = get(sp - 1)
+            put(sp, b)
+            sp -= 1
+            if (a[1] is not None) and (b[1] is not None):
+                put(sp, constant(_fold_(opcode, b[1], a[1])))
+                continue
+            template = BINARY[opcode]
+            if (a[1] is not None) and (opcode in BINARY_CONSTANT):
+                if (opcode in (OP_DIV, OP_MOD)) and (a[1] == 0):
+                    template = '0'
+                elif (opcode in (OP_LSHIFT, OP_RSHIFT)) and (a[1] >= 32):
+                    template = '0'
+                else:
+                    template = BINARY_CONSTANT[opcode]
+            n = coarseness(opcode, b, a, bits(b), bits(a))
+            put(sp, assign(template % {'a': operand(a, n), 'b': operand(b, n)}, n))
+
+    top = get(sp)
+    store()
+    if tops:  # numbers longer than 8 digits are pushed whole
+        body.append('buf[i] = %s & 0xFFFFFFFF' % top[0])
+    else:
+        body.append('buf[i] = %s & 0xFF' % top[0])
+    if sp & 0xFF:
+        body.append('sp = (sp + %d) & 0xFF' % (sp & 0xFF))
+
+    if not hoisted:
+        return TEMPLATE % {'body': '\n'.join(['        ' + line for line in body])}
+    return TEMPLATE_HOISTED % {
+        'mask': (1 << min(coarse.values())) - 1,
+        'hoisted': '\n'.join(['        ' + line for line in hoisted]),
+        'body': '\n'.join(['            ' + line for line in body])
+    }
+
+def _trailing_zeros_(value):
+    if value & MAXINT == 0:
+        return 32
+    return min((value & -value).bit_length() - 1, 32)
+
+def coarseness(opcode, b, a, b_bits, a_bits):
+    """
+    Returns the number of low bits of t the result of a binary operation
+    on values b and a does not depend on, given those of b and a. t alone
+    depends on all bits; constants (and cells) are given by the caller.
+    """
+    if (b[0] == 't') and (a[1] is not None):
+        if opcode == OP_RSHIFT:
+            return min(a[1], 32)  # shifted out
+        if opcode == OP_DIV:
+            return _trailing_zeros_(a[1])  # t // (c << n) == (t >> n) // c
+        if opcode == OP_AND:
+            return _trailing_zeros_(a[1])  # masked out
+    if (a[0] == 't') and (b[1] is not None) and (opcode == OP_AND):
+        return _trailing_zeros_(b[1])
+    return min(b_bits, a_bits)
+
+def generate(melody, tops=False):
+    """
+    Returns the generated render function for the program of melody.
+    Functions are cached by token list, so after an edit only a changed
+    program is compiled again.
+    """
+    key = (tuple(melody.tokens), tops)
+    try:
+        function = _cache.pop(key)
+    except KeyError:
+        namespace = {}
+        exec(compile(source(melody.program, tops),
+            '<glitch %s>' % str(melody), 'exec'), namespace)
+        function = namespace['render']
+    _cache[key] = function
+    while len(_cache) > CACHE_MAX:
+        _cache.popitem(last=False)
+    return function
+
+def render(melody, start, count, buf, tops=False):
+    """
+    Computes count samples of melody beginning at t = start into buf
+    like Melody._interpret_, using generated code. If tops is true, the
+    low 32 bits of the top of stack after every sample are written
+    instead, into a buffer of 32-bit items.
+    """
+    if tops:
+        function = generate(melody, True)
+    else:
+        function = melody.function
+        if function is None:
+            function = melody.function = generate(melody)
+
+    start = start & MAXINT
+    if start + count <= MAXINT + 1:
+        melody.sp = function(melody.cells, melody.sp, start, count, buf)
+    else:  # t wraps around
+        n = MAXINT + 1 - start
+        view = memoryview(buf)
+        melody.sp = function(melody.cells, melody.sp, start, n, view)
+        melody.sp = function(melody.cells, melody.sp, 0, count - n, view[n:])
+    return buf
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Mixes several melodies (voices) into one output, block by block, using
+# NumPy. Samples are unsigned 8-bit values around 128; voices are summed
+# around that, scaled by their gain, and saturated to 8 or 16 bits.
+#
+# Voices are added and removed between blocks, so every block is mixed
+# from the same voices. When there are more than PARALLEL_VOICES of them,
+# they are spread over worker processes, each keeping the melodies of its
+# voices (and their stacks) from block to block.
+
+from collections import deque
+from itertools import count as counter
+from multiprocessing import Pipe, Process
+from os import cpu_count
+
+import numpy
+
+from glitch import Melody
+
+BLOCKSIZE = 4096  # output samples mixed at once
+
+# more voices than this are rendered in worker processes, if jobs allow
+PARALLEL_VOICES = 8
+
+# gains are fixed point numbers with this many fractional bits, so sums
+# are exact no matter how voices are spread over processes
+GAIN_BITS = 16
+
+class Voice(object):
+    def __init__(self, melody, gain=1.0, offset=0, divider=1, muted=False):
+        """
+        A Voice plays melody in a Mixer. Its t begins at offset when it is
+        added and advances once every divider output samples, so dividers
+        above 1 play slower and lower. Muted voices are not computed;
+        once unmuted, melodies that forget their stack (see Melody.memory)
+        continue as if they never were, others from the stack they had.
+
+        gain, offset, divider and muted may be changed at any time; they
+        are used from the next block on.
+        """
+        self.melody = melody
+        self.gain = gain
+        self.offset = offset
+        self.divider = divider
+        self.muted = muted
+        self.joined = 0  # output position the voice was added at
+        self.next = 0  # t of the next sample to compute
+        self.last = 0  # sample computed before that
+
+    def _parameters_(self):
+        return self.gain, self.offset, self.divider, self.muted
+
+    def _mix_(self, position, count, mixed):
+        """
+        Adds the count samples of this voice beginning at output position,
+        centered around zero and scaled by gain, to mixed (int64).
+        """
+        if self.muted or not self.gain:
+            return
+
+        elapsed = position - self.joined
+        first = self.offset + elapsed // self.divider
+        last = self.offset + (elapsed + count - 1) // self.divider
+        held = int(first == self.next - 1)  # still playing the last sample
+        if (not held) and (first != self.next):  # muted or offset changed
+            if self.melody.memory is not None:
+                self.melody.seek(first)
+            self.next = first
+
+        buf = bytearray(held + last + 1 - self.next)
+        buf[0:held] = bytes([self.last] * held)
+        if last >= self.next:
+            self.melody.render(self.next, last + 1 - self.next,
+                memoryview(buf)[held:])
+            self.next = last + 1
+            self.last = buf[-1]
+
+        samples = numpy.frombuffer(buf, numpy.uint8).astype(numpy.int64)
+        if self.divider > 1:
+            samples = samples[(elapsed + numpy.arange(count)) // \
+                self.divider - elapsed // self.divider]
+        mixed += int(round(self.gain * (1 << GAIN_BITS))) * (samples - 128)
+
+class Mixer(object):
+    def __init__(self, bits=8, blocksize=BLOCKSIZE, jobs=None):
+        """
+        A Mixer renders the sum of its voices as unsigned 8-bit or signed
+        16-bit little-endian samples, saturating at their limits. More than
+        PARALLEL_VOICES voices are spread over jobs processes (by default
+        one per CPU).
+        """
+        if bits not in (8, 16):
+            raise ValueError('only 8 or 16 bits per sample')
+        self.bits = bits
+        self.blocksize = blocksize
+        self.jobs = jobs or cpu_count() or 1
+        self.position = 0  # output samples rendered so far
+        self._voices = []
+        self.changes = deque()  # (voice, added), applied between blocks
+        # (process, connection, voices, added, removed) once started; the
+        # voices added to and removed from a worker are sent with a block
+        self.workers = []
+        self.keys = {}  # voice: key in its worker
+        self.names = counter()
+
+    def add(self, voice):
+        """
+        Adds voice at the next block boundary and returns it.
+        """
+        self.changes.append((voice, True))
+        return voice
+
+    def remove(self, voice):
+        """
+        Removes voice at the next block boundary.
+        """
+        self.changes.append((voice, False))
+
+    def _get_voices_(self):
+        return list(self._voices)
+
+    voices = property(_get_voices_)
+
+    def _apply_changes_(self):
+        added = []
+        removed = []
+        while self.changes:
+            voice, add = self.changes.popleft()
+            if add and (voice not in self._voices):
+                voice.joined = self.position
+                voice.next = voice.offset
+                self._voices.append(voice)
+                added.append(voice)
+            elif (not add) and (voice in self._voices):
+                self._voices.remove(voice)
+                if voice in added:
+                    added.remove(voice)
+                else:
+                    removed.append(voice)
+
+        if self.workers:
+            self._send_changes_(added, removed)
+        elif (len(self._voices) > PARALLEL_VOICES) and (self.jobs > 1):
+            self._start_workers_()
+
+    def _start_workers_(self):
+        for i in range(self.jobs):
+            connection, child = Pipe()
+            process = Process(target=_work_, args=(child,))
+            process.daemon = True
+            process.start()
+            self.workers.append((process, connection, [], [], []))
+        self._send_changes_(self._voices, [])
+
+    def _send_changes_(self, added, removed):
+        for voice in removed:
+            key = self.keys.pop(voice)
+            for worker in self.workers:
+                if voice in worker[2]:
+                    worker[2].remove(voice)
+                    worker[4].append(key)
+        for voice in added:
+            worker = min(self.workers, key=lambda worker: len(worker[2]))
+            key = self.keys[voice] = next(self.names)
+            worker[2].append(voice)
+            m = voice.melody
+            worker[3].append((key, m.tokens, m.cells, m.sp, m.t,
+                voice.joined, voice.next, voice.last))
+
+    def render(self, count, out=None):
+        """
+        Mixes the next count samples. If out (a bytearray or writable
+        memoryview of count samples) is given, they are written there and
+        out is returned; otherwise a new bytes object is returned.
+        """
+        width = self.bits // 8
+        buf = bytearray(count * width) if out is None else out
+        view = memoryview(buf)
+        for offset in range(0, count, self.blocksize):
+            n = min(self.blocksize, count - offset)
+            self._apply_changes_()
+            mixed = numpy.zeros(n, numpy.int64)
+            if self.workers:
+                for process, connection, voices, added, removed in \
+                    self.workers:
+                    connection.send((added, removed, self.position, n,
+                        [(self.keys[voice], voice._parameters_()) \
+                            for voice in voices]))
+                    del added[:], removed[:]
+                for worker in self.workers:
+                    mixed += numpy.frombuffer(worker[1].recv_bytes(),
+                        numpy.int64)
+            else:
+                for voice in self._voices:
+                    voice._mix_(self.position, n, mixed)
+
+            # rounded to the nearest sample, halves upwards
+            if self.bits == 8:
+                shift = GAIN_BITS
+                samples = numpy.clip(((mixed + (1 << shift - 1)) >> shift) + \
+                    128, 0, 255).astype(numpy.uint8)
+            else:
+                shift = GAIN_BITS - 8
+                samples = numpy.clip((mixed + (1 << shift - 1)) >> shift,
+                    -32768, 32767).astype('<i2')
+            view[offset*width:(offset+n)*width] = samples.tobytes()
+            self.position += n
+
+        if out is None:
+            return bytes(buf)
+        return out
+
+    def close(self):
+        """
+        Stops the worker processes. While they ran, the melodies of the
+        voices in this process were not kept up to date.
+        """
+        for worker in self.workers:
+            worker[1].send(None)
+            worker[0].join()
+        self.workers = []
+        self.keys = {}
+
+def _work_(connection):
+    """
+    Mixes voices in a worker process: receives the voices added and
+    removed, output position, sample count and voice parameters of a
+    block and replies with the sum of its voices.
+    """
+    voices = {}  # key: Voice
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        added, removed, position, count, parameters = message
+        for key, tokens, cells, sp, t, joined, next, last in added:
+            m = Melody('')
+            m.tokens = tokens
+            m.cells = cells
+            m.sp = sp
+            m.t = t
+            voice = voices[key] = Voice(m)
+            voice.joined, voice.next, voice.last = joined, next, last
+        for key in removed:
+            del voices[key]
+
+        mixed = numpy.zeros(count, numpy.int64)
+        for key, (gain, offset, divider, muted) in parameters:
+            voice = voices[key]
+            voice.gain, voice.offset, voice.divider, voice.muted = \
+                gain, offset, divider, muted
+            voice._mix_(position, count, mixed)
+        connection.send_bytes(mixed.tobytes())
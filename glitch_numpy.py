@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# NumPy backend computing the samples of stateless melodies (those having
+# an expression, see glitch._analyze_) for whole blocks of t at once.
+
+from math import gcd
+
+import numpy
+
+from glitch import MAXINT, T, OP_MUL, OP_DIV, OP_ADD, OP_SUB, OP_MOD, \
+    OP_LSHIFT, OP_RSHIFT, OP_AND, OP_OR, OP_XOR, OP_NOT, OP_LT, OP_GT, OP_EQ
+
+CHUNKSIZE = 65536
+
+U32 = numpy.uint32
+TRUE = U32(MAXINT)
+FALSE = U32(0)
+
+def _div_(b, a):
+    return numpy.where(a == 0, FALSE, b // numpy.maximum(a, U32(1)))
+
+def _mod_(b, a):
+    return numpy.where(a == 0, FALSE, b % numpy.maximum(a, U32(1)))
+
+def _lshift_(b, a):
+    # shifting by 32 or more is undefined in C, so mask before shifting
+    return numpy.where(a < 32, b << (a & U32(31)), FALSE)
+
+def _rshift_(b, a):
+    return numpy.where(a < 32, b >> (a & U32(31)), FALSE)
+
+OPERATIONS = {
+    # uint32 arithmetic wraps around just like masking with MAXINT
+    OP_MUL: numpy.multiply,
+    OP_DIV: _div_,
+    OP_ADD: numpy.add,
+    OP_SUB: numpy.subtract,
+    OP_MOD: _mod_,
+    OP_LSHIFT: _lshift_,
+    OP_RSHIFT: _rshift_,
+    OP_AND: numpy.bitwise_and,
+    OP_OR: numpy.bitwise_or,
+    OP_XOR: numpy.bitwise_xor,
+    OP_NOT: numpy.invert,
+    OP_LT: lambda b, a: numpy.where(b < a, TRUE, FALSE),
+    OP_GT: lambda b, a: numpy.where(b > a, TRUE, FALSE),
+    OP_EQ: lambda b, a: numpy.where(b == a, TRUE, FALSE)
+}
+
+def vectorizable(expression):
+    """
+    Checks that all constants of an expression fit into 32 bits; longer
+    number literals are kept unmasked by the interpreter.
+    """
+    if expression is None:
+        return False
+    if isinstance(expression, int):
+        return expression <= MAXINT
+    for operand in expression[1:]:
+        if not vectorizable(operand):
+            return False
+    return True
+
+def evaluate(expression, t):
+    """
+    Evaluates an expression for an array of t values (dtype uint32).
+    Shared subexpressions (as created by OP_DUP) are computed once.
+    """
+    values = {}
+
+    def value(node):
+        if isinstance(node, int):
+            return U32(node)
+        if node is T:
+            return t
+        try:
+            return values[id(node)]
+        except KeyError:
+            operands = [value(operand) for operand in node[1:]]
+            result = values[id(node)] = OPERATIONS[node[0]](*operands)
+            return result
+
+    return numpy.broadcast_to(value(expression), t.shape)
+
+def render(melody, start, count, buf):
+    """
+    Computes count samples of melody beginning at t = start into buf,
+    falling back to the interpreter if the melody is not stateless.
+
+    The stack is left exactly as the interpreter would leave it: the
+    last samples are computed by the interpreter, enough of them for
+    the top-of-stack pointer to visit every cell the program writes.
+    """
+    if not vectorizable(melody.expression):
+        melody._render_(start, count, buf)
+        return buf
+
+    replay = min(count, 256 // gcd(melody.delta, 256))
+    vectorized = count - replay
+
+    out = numpy.frombuffer(buf, numpy.uint8, count)
+    for i in range(0, vectorized, CHUNKSIZE):
+        n = min(CHUNKSIZE, vectorized - i)
+        t = numpy.arange(start + i, start + i + n, dtype=numpy.uint64)
+        t = (t & MAXINT).astype(U32)
+        out[i:i+n] = evaluate(melody.expression, t) & 0xFF
+
+    melody.sp = (melody.sp + vectorized * melody.delta) & 0xFF
+    melody._render_(start + vectorized, replay, memoryview(buf)[vectorized:])
+    return buf
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Instrumentation for finding out which parts of a glitch cost the most.
+# Profiling is enabled by assigning a Profile to Melody.profile; samples
+# are then computed by the slower, instrumented interpreter below.
+
+from collections import deque
+from time import perf_counter
+
+from glitch import DISPATCH, MAXINT, OP_DIV, OP_MOD, STACK_EFFECTS
+
+OPCODE_NAMES = dict((number, 'OP_' + name) for number, name in \
+    enumerate(['NUMBER', 'T', 'PUT', 'DROP', 'MUL', 'DIV', 'ADD', 'SUB',
+        'MOD', 'LSHIFT', 'RSHIFT', 'AND', 'OR', 'XOR', 'NOT', 'DUP', 'PICK',
+        'SWAP', 'LT', 'GT', 'EQ']))
+
+BLOCKS = 1024  # timings of this many recent blocks are kept
+
+class Profile(object):
+    def __init__(self):
+        """
+        A Profile counts executions and time per opcode and per source
+        position (line, column), times rendered blocks and records how
+        far the stack pointer moves within a pass and how many divisions
+        (OP_DIV, OP_MOD) were by zero.
+        """
+        self.samples = 0
+        self.opcode_counts = [0] * len(DISPATCH)
+        self.opcode_times = [0.0] * len(DISPATCH)
+        self.position_counts = {}
+        self.position_times = {}
+        self.blocks = deque(maxlen=BLOCKS)  # (start, count, seconds)
+        self.divisions = 0
+        self.zero_divisions = 0
+        self.depth_min = 0  # relative to the stack pointer at pass start
+        self.depth_max = 0
+
+    def render(self, melody, start, count, buf):
+        """
+        Computes count samples of melody into buf like Melody._interpret_,
+        collecting statistics.
+        """
+        blockstart = perf_counter()
+
+        opcode_counts = self.opcode_counts
+        opcode_times = self.opcode_times
+        position_counts = self.position_counts
+        position_times = self.position_times
+        depth_min = self.depth_min
+        depth_max = self.depth_max
+
+        cells = melody.cells
+        sp = melody.sp
+        program = list(zip(melody.program, melody.origins))
+        for i in range(count):
+            t = (start + i) & MAXINT
+            depth = 0
+            for (opcode, argument), position in program:
+                if (opcode == OP_DIV) or (opcode == OP_MOD):
+                    self.divisions += 1
+                    if cells[sp] == 0:
+                        self.zero_divisions += 1
+
+                before = perf_counter()
+                sp = DISPATCH[opcode](cells, sp, t, argument)
+                elapsed = perf_counter() - before
+
+                opcode_counts[opcode] += 1
+                opcode_times[opcode] += elapsed
+                position_counts[position] = \
+                    position_counts.get(position, 0) + 1
+                position_times[position] = \
+                    position_times.get(position, 0.0) + elapsed
+
+                depth += STACK_EFFECTS[opcode]
+                if depth < depth_min:
+                    depth_min = depth
+                elif depth > depth_max:
+                    depth_max = depth
+            buf[i] = cells[sp] & 0xFF
+        melody.sp = sp
+
+        self.depth_min = depth_min
+        self.depth_max = depth_max
+        self.samples += count
+        self.blocks.append((start, count, perf_counter() - blockstart))
+
+    def zero_division_rate(self):
+        """
+        Returns the fraction of divisions that were by zero.
+        """
+        if not self.divisions:
+            return 0.0
+        return float(self.zero_divisions) / self.divisions
+
+    def opcodes(self):
+        """
+        Returns (name, count, seconds) for every opcode executed, most
+        expensive first.
+        """
+        result = [(OPCODE_NAMES[opcode], self.opcode_counts[opcode],
+            self.opcode_times[opcode]) for opcode in range(len(DISPATCH)) \
+            if self.opcode_counts[opcode]]
+        return sorted(result, key=lambda item: -item[2])
+
+    def positions(self):
+        """
+        Returns ((line, column), count, seconds) for every source position
+        executed, most expensive first.
+        """
+        # copied at once, as another thread may be rendering
+        counts = list(self.position_counts.items())
+        result = [(position, count, self.position_times.get(position, 0.0)) \
+            for position, count in counts]
+        return sorted(result, key=lambda item: -item[2])
+
+    def report(self):
+        """
+        Returns a human-readable summary.
+        """
+        lines = ['%d samples, stack depth %d..%d, %d of %d divisions by zero' % \
+            (self.samples, self.depth_min, self.depth_max,
+            self.zero_divisions, self.divisions)]
+        if self.blocks:
+            seconds = sum([block[2] for block in self.blocks])
+            samples = sum([block[1] for block in self.blocks])
+            lines.append('%d blocks, %.1f us per sample' % \
+                (len(self.blocks), seconds / samples * 1e6))
+        for name, count, seconds in self.opcodes():
+            lines.append('%-10s %10d %8.3fs' % (name, count, seconds))
+        for (line, column), count, seconds in self.positions()[:16]:
+            lines.append('line %-2s column %-2s %10d %8.3fs' % \
+                (line, column, count, seconds))
+        return '\n'.join(lines)
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Converts the samples of a melody, computed at SAMPLERATE, to other sample
+# rates and to 16 bits, block by block, using NumPy. Output sample j lies
+# at j * SAMPLERATE / rate samples of the melody; positions are computed
+# as exact fractions, so long renders do not drift.
+
+from math import ceil, gcd
+
+import numpy
+
+from glitch import SAMPLERATE
+
+BLOCKSIZE = 4096  # output samples computed at once
+
+# the band-limited filter reaches this many samples of the melody to
+# either side (more when lowering the rate), and is tabulated for this
+# many positions between two of them
+TAPS = 16
+PHASES = 256
+
+METHODS = ('direct', 'hold', 'bandlimited')
+
+class Resampler(object):
+    def __init__(self, melody, rate, bits=8, method='bandlimited', start=0):
+        """
+        A Resampler renders melody beginning at t = start as rate unsigned
+        8-bit or signed 16-bit little-endian samples per second.
+
+        With method 'hold', each sample of the melody is repeated as long
+        as it lasts (zero-order hold); 'bandlimited' interpolates them with
+        a windowed sinc filter instead, avoiding the aliasing of held
+        samples. With 'direct', t runs at rate, so the melody plays faster
+        and higher than at SAMPLERATE, and nothing is interpolated.
+        """
+        if method not in METHODS:
+            raise ValueError('unknown method %s' % method)
+        if bits not in (8, 16):
+            raise ValueError('only 8 or 16 bits per sample')
+        self.melody = melody
+        self.rate = rate
+        self.bits = bits
+        self.method = method
+        self.start = start
+        self.position = 0  # output samples rendered so far
+
+        divisor = gcd(SAMPLERATE, rate)
+        self.numerator = SAMPLERATE // divisor
+        self.denominator = rate // divisor
+
+        if method == 'bandlimited':
+            self.width, self.filter = _filter_(min(1.0,
+                float(rate) / SAMPLERATE))
+        else:
+            self.width, self.filter = 1, None
+        # samples of the melody from index base on, centered around zero;
+        # those before start are silent
+        self.base = -self.width
+        self.history = numpy.zeros(self.width)
+
+    def render(self, count, out=None):
+        """
+        Computes the next count samples. If out (a bytearray or writable
+        memoryview of count samples) is given, they are written there and
+        out is returned; otherwise a new bytes object is returned.
+        """
+        width = self.bits // 8
+        buf = bytearray(count * width) if out is None else out
+        view = memoryview(buf)
+        for offset in range(0, count, BLOCKSIZE):
+            n = min(BLOCKSIZE, count - offset)
+            if self.method == 'direct':
+                samples = self._source_(self.start + self.position, n)
+            else:
+                samples = self._interpolate_(n)
+
+            if self.bits == 8:
+                samples = numpy.clip(numpy.rint(samples) + 128, 0, 255)
+                samples = samples.astype(numpy.uint8)
+            else:
+                samples = numpy.clip(numpy.rint(samples * 256), -32768,
+                    32767).astype('<i2')
+            view[offset*width:(offset+n)*width] = samples.tobytes()
+            self.position += n
+
+        if out is None:
+            return bytes(buf)
+        return out
+
+    def _source_(self, t, count):
+        """
+        Returns count samples of the melody from t, centered around zero.
+        """
+        samples = numpy.frombuffer(self.melody.render(t, count), numpy.uint8)
+        return samples - 128.0
+
+    def _interpolate_(self, count):
+        j = numpy.arange(self.position, self.position + count, dtype=numpy.int64)
+        j *= self.numerator
+        index = j // self.denominator  # sample of the melody at or before
+
+        # compute the melody as far as the filter reaches, and forget what
+        # it no longer reaches
+        end = int(index[-1]) + self.width + 1
+        known = self.base + len(self.history)
+        if end > known:
+            self.history = numpy.concatenate((self.history,
+                self._source_(self.start + known, end - known)))
+        first = int(index[0]) - self.width + 1
+        if first > self.base:
+            self.history = self.history[first - self.base:]
+            self.base = first
+
+        if self.filter is None:  # held
+            return self.history[index - self.base]
+
+        phase = (j % self.denominator) * PHASES // self.denominator
+        window = index[:, None] - self.base + \
+            numpy.arange(1 - self.width, self.width + 1)
+        return numpy.einsum('ij,ij->i', self.history[window],
+            self.filter[phase])
+
+def _filter_(cutoff):
+    """
+    Returns the half width (in samples of the melody) of a Blackman
+    windowed sinc filter passing frequencies below cutoff times half the
+    rate of the melody, and its coefficients for PHASES positions between
+    two samples, each row summing up to one.
+    """
+    width = int(ceil(TAPS / cutoff))
+    fraction = numpy.arange(PHASES)[:, None] / float(PHASES)
+    distance = fraction - numpy.arange(1 - width, width + 1)[None, :]
+    window = 0.42 + 0.5 * numpy.cos(numpy.pi * distance / width) + \
+        0.08 * numpy.cos(2 * numpy.pi * distance / width)
+    coefficients = numpy.sinc(cutoff * distance) * window
+    return width, coefficients / coefficients.sum(axis=1)[:, None]
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Records the state of a melody while it renders, for visualisation.
+# Tapping is enabled by assigning a Tap to Melody.tap; samples are then
+# computed by generated code writing 32 bits of the top of stack (see
+# glitch_codegen), into NumPy arrays allocated once, so they can be read
+# without copying. Cycles are neither found nor copied while tapping.
+
+import numpy
+
+import glitch_codegen
+from glitch import MAXINT
+
+STRIDE = 256  # samples between two stack snapshots
+
+class Tap(object):
+    def __init__(self, size, stride=STRIDE):
+        """
+        A Tap records, for renders of up to size samples, the top of
+        stack after every sample (32 bits of it; a sample is its low 8
+        bits) and the stack cells and top-of-stack pointer after every
+        stride samples, counted from the start of the render.
+
+        After a render of count samples, tops[:count] and the first
+        count // stride rows of cells and pointers hold its state; see
+        stack for the order of the cells.
+        """
+        self.size = size
+        self.stride = stride
+        self.tops = numpy.zeros(size, numpy.uint32)
+        self.cells = numpy.zeros((size // stride, 256), numpy.uint32)
+        self.pointers = numpy.zeros(size // stride, numpy.uint8)
+        self.start = 0  # t of the first sample of the last render
+        self.count = 0  # samples of the last render
+
+    def _get_snapshots_(self):
+        return self.count // self.stride
+
+    snapshots = property(_get_snapshots_)
+
+    def stack(self, index):
+        """
+        Returns the cells of snapshot index ordered from bottom to top,
+        like Melody.stack.
+        """
+        return numpy.roll(self.cells[index], -1 - int(self.pointers[index]))
+
+    def render(self, melody, start, count, buf):
+        """
+        Computes count samples of melody into buf like Melody._render_,
+        recording their state. Checkpoints for seeking are taken as when
+        rendering untapped.
+        """
+        if count > self.size:
+            raise ValueError('only %d samples can be tapped at once' % \
+                self.size)
+        tops = memoryview(self.tops)
+        stride = self.stride
+        offset = 0
+        while offset < count:
+            t = start + offset
+            interval = melody.checkpoint_interval
+            if (melody.t is not None) and (melody.memory is None) and \
+                (t % interval == 0):
+                melody.t = t
+                melody._checkpoint_()
+                interval = melody.checkpoint_interval
+            n = min(count - offset, stride - offset % stride,
+                interval - t % interval)
+            glitch_codegen.render(melody, t, n, tops[offset:offset+n], True)
+            offset += n
+            if offset % stride == 0:
+                row = offset // stride - 1
+                try:
+                    self.cells[row] = melody.cells
+                except OverflowError:  # numbers longer than 8 digits
+                    self.cells[row] = [cell & MAXINT for cell in melody.cells]
+                self.pointers[row] = melody.sp
+
+        samples = numpy.frombuffer(buf, numpy.uint8, count)
+        numpy.bitwise_and(self.tops[:count], 0xFF, out=samples,
+            casting='unsafe')
+        self.start = start
+        self.count = count
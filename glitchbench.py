@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#       
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#       
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Benchmarks every glitch in tracks/ and tests/ (or the files given) and
+# records hashes of their output, computed sample by sample by _compute_,
+# so faster ways of rendering can be checked against them.
+#
+# With --startup, measures how long short renders take to start instead:
+# shell pipelines run thousands of them, so importing glitch must stay
+# cheap, with accelerators (NumPy, generated code, profiling) imported
+# only when they pay off. Importing one fails the check; times over their
+# budget are only reported, as they depend on the machine and its load.
+
+from argparse import ArgumentParser
+from glob import glob
+from hashlib import sha1
+from json import dump, load
+from os import devnull, path
+from platform import python_version
+from subprocess import PIPE, check_call, run
+from sys import executable, stderr, stdout
+from time import perf_counter, time
+import tracemalloc
+
+import glitch
+
+def benchmark(filename, samples):
+    with open(filename) as f:
+        source = f.read().replace('\n', '')
+
+    result = {}
+
+    starttime = time()
+    m = glitch.Melody(source)
+    result['construct_seconds'] = time() - starttime
+
+    starttime = time()
+    m._tokenize_(m.lines[1:])
+    result['tokenize_seconds'] = time() - starttime
+
+    starttime = time()
+    output = bytes([m._compute_(t) for t in range(samples)])
+    seconds = time() - starttime
+    result['compute_samples_per_second'] = samples / seconds
+    result['compute_realtime_factor'] = samples / seconds / glitch.SAMPLERATE
+    result['sha1'] = sha1(output).hexdigest()
+
+    m = glitch.Melody(source)
+    starttime = time()
+    rendered = m.render(0, samples)
+    seconds = time() - starttime
+    result['render_samples_per_second'] = samples / seconds
+    result['render_realtime_factor'] = samples / seconds / glitch.SAMPLERATE
+    result['render_matches'] = (rendered == output)
+
+    m = glitch.Melody(source)
+    tracemalloc.start()
+    m.render(0, samples)
+    result['render_peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result
+
+# (name, interpreter arguments, modules not to be imported, milliseconds
+# expected on top of starting the interpreter)
+STARTUP = [
+    ('import glitch', ['-c', 'import glitch'],
+        ['numpy', 'glitch_numpy', 'glitch_codegen', 'glitch_profile',
+            'multiprocessing'], 10),
+    ('glitter.py --samples 8000', ['glitter.py', '--samples', '8000',
+        '--output', devnull, 'tracks/42_forever.glitch'],
+        ['numpy', 'glitch_numpy', 'glitch_profile', 'multiprocessing'], 50)
+]
+
+def startup(arguments, runs):
+    """
+    Returns the shortest time the interpreter took to run with arguments
+    and the names of the modules it imported.
+    """
+    here = path.dirname(path.abspath(__file__))
+    seconds = []
+    for i in range(runs):
+        starttime = perf_counter()
+        check_call([executable] + arguments, cwd=here, stderr=PIPE)
+        seconds.append(perf_counter() - starttime)
+    imports = run([executable, '-X', 'importtime'] + arguments, cwd=here,
+        stderr=PIPE, universal_newlines=True).stderr
+    modules = set([line.split('|')[-1].strip() \
+        for line in imports.splitlines() if line.startswith('import time:')])
+    return min(seconds), modules
+
+def golden(filename, samples):
+    with open(filename) as f:
+        m = glitch.Melody(f.read().replace('\n', ''))
+    return {'sha1': sha1(bytes([m._compute_(t) for t in range(samples)])).hexdigest()}
+
+parser = ArgumentParser(usage='glitchbench.py [OPTIONS] [FILE...]')
+parser.add_argument('files', metavar='FILE', nargs='*',
+    help='glitch files (default: tracks/*.glitch and tests/*.glitch)')
+parser.add_argument('--samples', metavar='N', type=int, default=16000,
+    help='samples computed per file (default: 16000)')
+parser.add_argument('--output', metavar='JSON',
+    help='save results to JSON')
+parser.add_argument('--compare', metavar='JSON',
+    help='compare speed and output hashes with earlier results')
+parser.add_argument('--hashes-only', action='store_true',
+    help='only compute output hashes, without timing anything')
+parser.add_argument('--startup', action='store_true',
+    help='measure startup of short renders and check their imports')
+parser.add_argument('--runs', metavar='N', type=int, default=10,
+    help='runs per startup measurement, the fastest counts (default: 10)')
+args = parser.parse_args()
+
+if args.startup:
+    failures = 0
+    bare, _ = startup(['-c', 'pass'], args.runs)
+    results = {'python': python_version(), 'bare_seconds': bare,
+        'startup': {}}
+    stdout.write('%-36s %8.1f ms\n' % ('python -c pass', bare * 1000))
+    for name, arguments, forbidden, budget in STARTUP:
+        if arguments[-1].endswith('.glitch'):
+            with open(arguments[-1]) as f:
+                arguments = arguments[:-1] + [f.read().replace('\n', '')]
+        seconds, modules = startup(arguments, args.runs)
+        extra = (seconds - bare) * 1000
+        results['startup'][name] = {'seconds': seconds,
+            'modules': sorted(modules)}
+        line = '%-36s %+8.1f ms' % (name, extra)
+        if extra > budget:
+            line += ' SLOWER THAN %d ms' % budget
+        imported = sorted(modules.intersection(forbidden))
+        if imported:
+            line += ' IMPORTS ' + ' '.join(imported)
+            failures += 1
+        stdout.write(line + '\n')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            dump(results, f, indent=1, sort_keys=True)
+    if failures:
+        stderr.write('%d startup checks failed.\n' % failures)
+        exit(1)
+    exit(0)
+
+files = args.files
+if not files:
+    here = path.dirname(path.abspath(__file__))
+    files = sorted(glob(path.join(here, 'tracks', '*.glitch'))) + \
+        sorted(glob(path.join(here, 'tests', '*.glitch')))
+    files = [path.relpath(f, here) for f in files]
+
+earlier = None
+if args.compare:
+    with open(args.compare) as f:
+        earlier = load(f)
+    if earlier['samples'] != args.samples:
+        stderr.write('%s has results for %d samples, not %d.\n' % \
+            (args.compare, earlier['samples'], args.samples))
+        exit(2)
+
+results = {
+    'samples': args.samples,
+    'python': python_version(),
+    'files': {}
+}
+
+failures = 0
+for filename in files:
+    if args.hashes_only:
+        result = golden(filename, args.samples)
+        line = '%-36s %s' % (filename, result['sha1'])
+    else:
+        result = benchmark(filename, args.samples)
+        line = '%-36s %10.0f/s %10.0f/s %8.1fx %8d B' % (filename,
+            result['compute_samples_per_second'],
+            result['render_samples_per_second'],
+            result['render_realtime_factor'],
+            result['render_peak_memory_bytes'])
+        if not result['render_matches']:
+            line += ' RENDER MISMATCH'
+            failures += 1
+    results['files'][filename] = result
+
+    if earlier and (filename in earlier['files']):
+        before = earlier['files'][filename]
+        if before['sha1'] != result['sha1']:
+            line += ' HASH MISMATCH'
+            failures += 1
+        if ('render_samples_per_second' in before) and \
+            ('render_samples_per_second' in result):
+            line += ' %5.2fx' % (result['render_samples_per_second'] / \
+                before['render_samples_per_second'])
+    stdout.write(line + '\n')
+
+if args.output:
+    with open(args.output, 'w') as f:
+        dump(results, f, indent=1, sort_keys=True)
+
+if failures:
+    stderr.write('%d mismatches.\n' % failures)
+    exit(1)
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Client for glitchd.py, writing samples like glitter.py does; see there
+# for the protocol.
+
+import json
+import socket
+from argparse import ArgumentParser
+from sys import stderr, stdout
+
+from glitch import GlitchError, SAMPLERATE
+
+SOCKET = '/tmp/glitchd.socket'  # default address of glitchd.py
+BUFSIZE = 65536
+
+def connect(address=SOCKET):
+    """
+    Connects to glitchd at a Unix socket path or a (host, port) pair.
+    """
+    if isinstance(address, tuple):
+        return socket.create_connection(address)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(address)
+    return connection
+
+def render(glitch, start=0, count=None, format='raw', rate=SAMPLERATE,
+    address=SOCKET):
+    """
+    Asks glitchd to render count samples of glitch beginning at t = start
+    (forever if count is None). Returns the normalised melody and an
+    iterator over blocks of samples, preceded by a WAVE header if format
+    is 'wav'. Raises ValueError if glitchd rejects the request, or a
+    GlitchError if it rejects the glitch.
+    """
+    connection = connect(address)
+    request = {'glitch': glitch, 'start': start, 'count': count,
+        'format': format, 'rate': rate}
+    connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+    stream = connection.makefile('rb')
+    reply = json.loads(stream.readline().decode('utf-8') or '{}')
+    if 'melody' not in reply:
+        connection.close()
+        if 'diagnostics' in reply:
+            raise GlitchError([tuple(d) for d in reply['diagnostics']])
+        raise ValueError(reply.get('error', 'no reply from glitchd'))
+
+    def blocks():
+        try:
+            while True:
+                block = stream.read1(BUFSIZE)
+                if not block:
+                    break
+                yield block
+        finally:
+            stream.close()
+            connection.close()
+
+    return reply['melody'], blocks()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(usage='glitchc.py [OPTIONS] FORMULA')
+    parser.add_argument('formula', metavar='FORMULA')
+    parser.add_argument('--start', metavar='T', type=int, default=0,
+        help='begin at t = T instead of 0')
+    parser.add_argument('--samples', '--render', metavar='N', type=int,
+        help='write N samples and exit instead of playing forever')
+    parser.add_argument('--seconds', metavar='S', type=float,
+        help='write S seconds of samples and exit')
+    parser.add_argument('--format', choices=['raw', 'wav'], default='raw',
+        help='write bare unsigned 8-bit samples or a WAVE file (default: raw)')
+    parser.add_argument('--rate', metavar='HZ', type=int, default=SAMPLERATE,
+        help='sample rate for --seconds and WAVE headers (default: %d)' % \
+            SAMPLERATE)
+    parser.add_argument('--output', metavar='FILE', default='-',
+        help='write to FILE instead of standard output')
+    parser.add_argument('--socket', metavar='PATH', default=SOCKET,
+        help='connect to glitchd at this Unix socket (default: %s)' % SOCKET)
+    parser.add_argument('--port', metavar='N', type=int,
+        help='connect to glitchd at this TCP port instead')
+    parser.add_argument('--host', metavar='HOST', default='localhost',
+        help='host for --port (default: localhost)')
+    args = parser.parse_args()
+
+    count = args.samples
+    if args.seconds is not None:
+        count = int(args.seconds * args.rate)
+
+    address = args.socket
+    if args.port is not None:
+        address = (args.host, args.port)
+
+    try:
+        melody, blocks = render(args.formula, args.start, count, args.format,
+            args.rate, address)
+    except (ValueError, OSError) as error:
+        stderr.write('glitchc.py: %s\n' % error)
+        exit(1)
+    stderr.write(melody)
+
+    if args.output == '-':
+        output = getattr(stdout, 'buffer', stdout)
+    else:
+        output = open(args.output, 'wb')
+
+    try:
+        for block in blocks:
+            output.write(block)
+        output.close()
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Render daemon, so that many short renders pay neither for starting the
+# interpreter nor for compiling the same melodies again. Clients connect
+# to a Unix socket (or a TCP port) and send one line of JSON:
+#
+#   {"glitch": "...", "start": 0, "count": 8000, "format": "raw", "rate": 8000}
+#
+# count may be null to render until the client disconnects. The reply is
+# one line of JSON, either {"melody": normalised glitch} followed by the
+# samples (after a WAVE header if format is "wav"), or {"error": message}.
+# Errors about the glitch itself also have "diagnostics", a list of
+# [line, column, reason]; see glitch.parse.
+
+import asyncio
+import json
+from argparse import ArgumentParser
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count, path, remove
+from struct import error as StructError
+
+from glitch import GlitchError, Melody, BLOCKSIZE, SAMPLERATE, wav_header
+from glitchc import SOCKET
+
+CACHE_MAX = 256  # melodies kept, least recently used dropped
+
+# melodies that never forget their stack are computed from t = 0 up to
+# start (see Melody.seek), in a worker that can not be stopped meanwhile;
+# later starts are refused
+SEEK_MAX = 8000 * 60 * 10
+
+# in worker processes: tuple(tokens): melody, so every block of a melody
+# after the first is computed without compiling and analyzing it again
+_melodies = OrderedDict()
+
+def _render_block_(arguments):
+    """
+    Renders a block of samples in a worker process. Without a stack, the
+    melody is first brought to start, see Melody.seek. Returns the samples
+    and the stack after them.
+    """
+    tokens, cells, sp, start, count = arguments
+    key = tuple(tokens)
+    try:
+        m = _melodies.pop(key)
+    except KeyError:
+        m = Melody('')
+        m.tokens = tokens
+    _melodies[key] = m
+    while len(_melodies) > CACHE_MAX:
+        _melodies.popitem(last=False)
+    if cells is None:
+        m.seek(start)
+    else:
+        m.cells = cells
+        m.sp = sp
+    return m.render(start, count), m.cells, m.sp
+
+class Daemon(object):
+    def __init__(self, jobs=None, cache_max=CACHE_MAX, strict=False,
+        seek_max=SEEK_MAX):
+        """
+        A Daemon renders requests in a pool of jobs processes (by default
+        one per CPU) and keeps the last cache_max melodies compiled. If
+        strict is true, glitches not following the format are refused.
+        Requests starting after seek_max are refused for melodies that
+        never forget their stack.
+        """
+        self.jobs = jobs or cpu_count() or 1
+        # workers are started on demand, when the event loop has threads
+        # running already, so they must not be forked from this process
+        self.pool = ProcessPoolExecutor(self.jobs, get_context('forkserver'))
+        self.cache_max = cache_max
+        self.melodies = OrderedDict()  # glitch: melody
+        self.strict = strict
+        self.seek_max = seek_max
+
+    def melody(self, glitch):
+        """
+        Returns the melody for a glitch, parsed, compiled and analyzed once
+        for all requests with the same glitch.
+        """
+        try:
+            m = self.melodies.pop(glitch)
+        except (KeyError, TypeError):  # not kept, or not even a string
+            m = Melody(glitch, strict=self.strict)
+            m.memory  # analyzed here, not for every request
+        self.melodies[glitch] = m
+        while len(self.melodies) > self.cache_max:
+            self.melodies.popitem(last=False)
+        return m
+
+    async def handle(self, reader, writer):
+        """
+        Answers a single request, see the top of this file.
+        """
+        try:
+            request = json.loads((await reader.readline()).decode('utf-8'))
+            m = self.melody(request['glitch'])
+            start = int(request.get('start', 0))
+            count = request.get('count')
+            if count is not None:
+                count = int(count)
+            format = request.get('format', 'raw')
+            rate = int(request.get('rate', SAMPLERATE))
+            if start < 0:
+                raise ValueError('start must not be negative')
+            if (start > self.seek_max) and (m.memory is None):
+                raise ValueError('start must not be after %d for melodies '
+                    'that never forget their stack' % self.seek_max)
+            if (count is not None) and (count < 0):
+                raise ValueError('count must not be negative')
+            if rate <= 0:
+                raise ValueError('rate must be positive')
+            if format == 'wav':
+                header = wav_header(count, rate)
+            elif format == 'raw':
+                header = b''
+            else:
+                raise ValueError('unknown format %s' % format)
+        except (ValueError, KeyError, TypeError, AttributeError,
+            StructError) as error:
+            reply = {'error': str(error) or error.__class__.__name__}
+            if isinstance(error, GlitchError):
+                reply['diagnostics'] = error.diagnostics
+            writer.write((json.dumps(reply) + '\n').encode('utf-8'))
+            await self.close(writer)
+            return
+
+        try:
+            writer.write((json.dumps({'melody': str(m)}) + '\n').encode('utf-8'))
+            writer.write(header)
+            await self.stream(m, start, count, writer)
+        except ConnectionError:
+            pass  # the client went away
+        await self.close(writer)
+
+    async def stream(self, melody, start, count, writer):
+        """
+        Writes count samples of melody beginning at t = start (forever if
+        count is None), waiting for the client to take them.
+
+        Melodies that forget their stack are rendered by several processes
+        at once, every block brought to its start independently. Other
+        melodies are rendered block after block, each continuing from the
+        stack left by the one before.
+        """
+        loop = asyncio.get_running_loop()
+        if melody.memory is not None:
+            ahead = self.jobs
+        else:
+            ahead = 1
+        cells = sp = None
+        pending = deque()
+        t = start
+        end = None if count is None else start + count
+        try:
+            while pending or (end is None) or (t < end):
+                while (len(pending) < ahead) and ((end is None) or (t < end)):
+                    n = BLOCKSIZE if end is None else min(BLOCKSIZE, end - t)
+                    pending.append(loop.run_in_executor(self.pool,
+                        _render_block_, (melody.tokens, cells, sp, t, n)))
+                    t += n
+                samples, last_cells, last_sp = await pending.popleft()
+                if ahead == 1:
+                    cells, sp = last_cells, last_sp
+                writer.write(samples)
+                await writer.drain()  # only render ahead what is taken
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def close(self, writer):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def serve(daemon, socket=SOCKET, host=None, port=None):
+    """
+    Serves requests on a Unix socket, or a TCP port if one is given.
+    """
+    if port is not None:
+        server = await asyncio.start_server(daemon.handle, host, port)
+    else:
+        if path.exists(socket):
+            remove(socket)
+        server = await asyncio.start_unix_server(daemon.handle, socket)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = ArgumentParser(usage='glitchd.py [OPTIONS]')
+    parser.add_argument('--socket', metavar='PATH', default=SOCKET,
+        help='listen at this Unix socket (default: %s)' % SOCKET)
+    parser.add_argument('--port', metavar='N', type=int,
+        help='listen at this TCP port instead')
+    parser.add_argument('--host', metavar='HOST', default='localhost',
+        help='host for --port (default: localhost)')
+    parser.add_argument('--jobs', metavar='K', type=int,
+        help='number of processes used for rendering (default: one per CPU)')
+    parser.add_argument('--cache', metavar='N', type=int, default=CACHE_MAX,
+        help='number of compiled melodies kept (default: %d)' % CACHE_MAX)
+    parser.add_argument('--strict', action='store_true',
+        help='refuse glitches not following the format')
+    parser.add_argument('--seek-max', metavar='T', type=int, default=SEEK_MAX,
+        help='refuse to start after t = T melodies that never forget '
+            'their stack, as all samples before are computed '
+            '(default: %d)' % SEEK_MAX)
+    args = parser.parse_args()
+
+    daemon = Daemon(args.jobs, args.cache, args.strict, args.seek_max)
+    try:
+        asyncio.run(serve(daemon, args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.pool.shutdown(cancel_futures=True)
+        if (args.port is None) and path.exists(args.socket):
+            remove(args.socket)
@@ -16,11 +16,13 @@
 #       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #       MA 02110-1301, USA.
 
+from collections import deque
 from sys import argv, stderr, stdout
-from time import time
+import threading
 
 import pygame
 import glitch
+import glitch_tap
 import numpy
 
 #import pycallgraph
@@ -35,6 +37,8 @@ SCALE = 2
 GRID = TILESIZE * SCALE
 
 BUFSIZE = 256
+RINGSIZE = 8  # blocks rendered ahead of playback
+SEEKSTEP = 8000 * 4  # samples skipped by F2 / F3
 
 OPCODE_KEYMAP = {
     pygame.K_SPACE: '.',
@@ -114,15 +118,27 @@ TEXT_KEYMAP = {
 OPCODE_ORDER = '0123456789ABCDEFabcdefghjklmnopqrstu.'
 TEXT_ORDER = 'abcdefghijklmnopqrstuvwxyz0123456789_.'
 
-if len(argv) != 2:
-    stderr.write('Usage: glitched.py [glitchfile]\n')
+arguments = argv[1:]
+cache = None
+if arguments[:1] == ['--cache']:  # keep samples, see glitch_cache
+    import glitch_cache
+    cache = glitch_cache.Cache()
+    arguments = arguments[1:]
+
+if len(arguments) != 1:
+    stderr.write('Usage: glitched.py [--cache] [glitchfile]\n')
     exit(1)
 
-with open(argv[1]) as f:
+with open(arguments[0]) as f:
     input = f.read().replace('\n', '')
     m = glitch.Melody(input)
+for warning in m.warnings:
+    stderr.write('line %d, column %d: %s\n' % warning)
 
 m._expand_(m.lines)
+# the lines as drawn; m.lines is only changed by the synthesizer thread,
+# when it applies an edit at a block boundary
+lines = list(m.lines)
 
 pygame.mixer.pre_init(8000, 8, 1, BUFSIZE)
 pygame.init()
@@ -137,148 +153,206 @@ screen = pygame.display.set_mode((
 tileset = pygame.transform.scale(
     pygame.image.load('fontset.png'),
     (100*GRID, 4*GRID)
-).convert()
+)
 
 curpos = [0, 0]
 
-tilecache = {}
-
 MODE_TEXT = 0
 MODE_OPCODE = 1
 MODE_OPCODE_MUTED = 2
 MODE_ITERATOR = 3
 
-def tile(char, mode=MODE_OPCODE):
-    global tilecache
-    try:
-        return tilecache[char][mode]
-    except KeyError:
-        tile = pygame.Surface((GRID, GRID), pygame.HWSURFACE).convert()
-        tile.set_colorkey((0, 0, 0))
-
-        try:
-            index = (ord(char) - 32)
-        except TypeError:
-            if (char == 'CURSOR'):
-                index = 0
-        x = GRID * index
-        y = GRID * mode
+ATLAS_ORDER = ' ' + ''.join(sorted(set(OPCODE_ORDER + TEXT_ORDER)))
+
+# Every glyph in every mode, packed into one surface at startup; the cursor
+# is the space glyph drawn on top of a cell.
+atlas = pygame.Surface((len(ATLAS_ORDER)*GRID, 4*GRID)).convert()
+atlas.set_colorkey((0, 0, 0))
+glyphs = {}
+for mode in (MODE_TEXT, MODE_OPCODE, MODE_OPCODE_MUTED, MODE_ITERATOR):
+    for index, char in enumerate(ATLAS_ORDER):
+        glyphs[char, mode] = pygame.Rect(index*GRID, mode*GRID, GRID, GRID)
+        atlas.blit(tileset, glyphs[char, mode],
+            ((ord(char) - 32)*GRID, mode*GRID, GRID, GRID))
+del tileset
+CURSOR = glyphs[' ', MODE_OPCODE]
+
+BACKGROUND = (253, 246, 227)  # Solarized Base03
+blank = pygame.Surface((GRID, GRID)).convert()  # blits faster than fill()
+blank.fill(BACKGROUND)
 
-        tile.blit(tileset, (0, 0), (x, y, GRID, GRID))
+mutedlines = set()
+profile = None  # shown in the text panel; the synthesizer has its own copy
+tints = {}  # (row, column): color of profiled cells
+iterator = ''  # counter as drawn in the bottom row
+dirty = set()  # (row, column) of cells to redraw
 
-        try:
-            tilecache[char][mode] = tile
-        except KeyError:
-            tilecache[char] = { mode: tile }
+def touch_line(row):
+    dirty.update((row, column) for column in range(TEXT_WIDTH))
 
-        return tile
+def draw_cell(row, column):
+    """
+    Draws one cell of the text panel and returns its rect on screen.
+    """
+    rect = pygame.Rect((GRAPH_WIDTH + column)*GRID, row*GRID, GRID, GRID)
+    if (row, column) in tints:
+        screen.fill(tints[row, column], rect)
+    else:
+        screen.blit(blank, rect)
+
+    if row == 0:
+        mode = MODE_TEXT  # title
+    elif row in mutedlines:
+        mode = MODE_OPCODE_MUTED
+    else:
+        mode = MODE_OPCODE
+    if row < len(lines) and column < len(lines[row]):
+        char = lines[row][column]
+        if (char != '.') and (char, mode) in glyphs:  # NOP, not drawn
+            screen.blit(atlas, rect, glyphs[char, mode])
+
+    if [column, row] == curpos:
+        screen.blit(atlas, rect, CURSOR)
+
+    if row == TEXT_HEIGHT-1:
+        index = column - (TEXT_WIDTH - len(iterator))
+        if index >= 0:
+            screen.blit(atlas, rect, glyphs[iterator[index], MODE_ITERATOR])
+    return rect
 
-mutedlines = set()
 def draw_controls():
-    screen.fill(
-        (253, 246, 227),  # Solarized Base03
-        (GRAPH_WIDTH*GRID, 0, TEXT_WIDTH*GRID + GRAPH_WIDTH*GRID, TEXT_HEIGHT*GRID)
-    )
-
-    for i, line in enumerate(m.lines):
-        if (i == 0):
-            mode = MODE_TEXT  # title
-        else:
-            if i in mutedlines:
-                mode = MODE_OPCODE_MUTED
-            else:
-                mode = MODE_OPCODE
-        for j, char in enumerate(line):
-            if (char != '.'):  # NOP, not drawn
-                screen.blit(tile(char, mode), (j*GRID + GRAPH_WIDTH*GRID, i*GRID))
+    """
+    Redraws the cells of the text panel that changed since the last call.
+    """
+    if profile is not None:
+        draw_profile()
 
-    screen.blit(tile('CURSOR'), (curpos[0]*GRID + GRAPH_WIDTH*GRID, curpos[1]*GRID))
-    pygame.display.update((GRAPH_WIDTH*GRID, 0, TEXT_WIDTH*GRID, TEXT_HEIGHT*GRID))
+    pygame.display.update([draw_cell(row, column) for row, column in dirty])
+    dirty.clear()
 
+def draw_profile():
+    """
+    Tints the cells of tokens by the time spent executing them.
+    """
+    positions = profile.positions()
+    if not positions:
+        return
+    maxtime = positions[0][2] or 1
+    for (row, column), count, seconds in positions:
+        if row is None:
+            continue
+        share = seconds / maxtime
+        color = (
+            int(253 + (220-253)*share),  # from Solarized Base03
+            int(246 + (50-246)*share),  # to Solarized Red
+            int(227 + (47-227)*share)
+        )
+        if tints.get((row, column)) != color:
+            tints[row, column] = color
+            dirty.add((row, column))
+
+def clear_profile():
+    dirty.update(tints)
+    tints.clear()
+
+for row in range(TEXT_HEIGHT):
+    touch_line(row)
 draw_controls()
 
-valuepattern = pygame.Surface((136, 128), pygame.HWSURFACE)
-valuepattern.convert()
+# Graph layers are numpy arrays of mapped pixels indexed [x][y], like
+# pygame.surfarray.pixels2d(); they persist and scroll between blocks.
+graph = pygame.Surface((128, 128)).convert()
+scaledgraph = pygame.Surface((GRAPH_WIDTH*GRID, GRAPH_HEIGHT*GRID)).convert()
+graphpixels = pygame.surfarray.array2d(graph)
+
+ROWS = numpy.arange(128)
+BASE02 = graph.map_rgb((7, 54, 66))  # Solarized Base02
+RED = graph.map_rgb((220, 50, 47))  # Solarized Red
+BLUE = graph.map_rgb((38, 139, 210))  # Solarized Blue
 
-def draw_valuepattern(buf, target, drop_frame=False):
+valuepattern = numpy.zeros((128, 128), numpy.uint8)
+VALUEPATTERN_COLORS = pygame.surfarray.map_array(graph, numpy.minimum(
+    numpy.arange(256)[:, None] + (133, 153, 0), 255  # gray plus Solarized Green
+)[None])[0].astype(graphpixels.dtype)
+
+def draw_valuepattern(samples, target):
     """
     Draws a pattern with color determined by sample.
     """
-    global valuepattern
-    if not drop_frame:
-        for x, y in enumerate(buf):
-            valuepattern.set_at((127, int(127-x/2)), (y, y, y))
-    target.fill((133, 153, 0))  # Solarized Green
-    target.blit(valuepattern, (0, 0), (0, 0, 128, 128), pygame.BLEND_ADD)
-    valuepattern.scroll(-1, 0)
-
-ypattern = pygame.Surface((136, 128), pygame.HWSURFACE)
-ypattern.convert()
-ypattern.set_colorkey((0, 0, 0))
-
-def draw_ypattern(buf, target, drop_frame=False):
+    valuepattern[:-1] = valuepattern[1:]
+    column = samples[1::2]
+    valuepattern[-1, 128-len(column):] = column[::-1]
+    numpy.take(VALUEPATTERN_COLORS, valuepattern, out=target)
+
+ypattern = numpy.zeros_like(graphpixels)  # 0 is transparent
+
+def draw_ypattern(samples, target):
     """
     Draws a pattern with y coordinate determined by sample.
     """
-    global ypattern
-    if not drop_frame:
-        yarray = pygame.surfarray.pixels2d(ypattern)
-        for sample in buf: # shadow
-            y = 127-sample/2
-            yarray[127][y] = 0x073642  # Solarized Base02
-            yarray[126][y] = 0x073642
-        for sample in buf:
-            y = 126-sample/2
-            yarray[127][y] = 0xdc322f  # Solarized Red
-            yarray[126][y] = 0xdc322f
-        del yarray
-    target.blit(ypattern, (0, 0), (0, 0, 128, 128))
-    ypattern.scroll(-2, 0)
+    ypattern[:-2] = ypattern[2:]
+    ypattern[-2:] = 0
+    y = samples // 2
+    ypattern[-2:, 127 - y] = BASE02  # shadow
+    ypattern[-2:, 126 - y.astype(numpy.intp)] = RED  # -1 wraps to the bottom
+    numpy.copyto(target, ypattern, where=ypattern != 0)
 
 oldsample = 0
 
-def draw_wave(buf, target, drop_frame=False):
+def draw_wave(samples, target):
     """
     Draws the local wave (256 samples).
     """
-    if not drop_frame:
-        global oldsample
-        for x, sample in enumerate(buf):
-            pygame.draw.line(target, (7, 54, 66), (x/2, 128-sample/2),
-                (x/2, 128-oldsample/2))  # shadow
-            pygame.draw.line(target, (7, 54, 66), (x/2+1, 128-sample/2),
-                (x/2+1, 128-oldsample/2))  # shadow
-            pygame.draw.line(target, (38, 139, 210), (x/2, 127-sample/2),
-                (x/2, 127-oldsample/2))  # Solarized Blue
-            oldsample = sample
-
-import colorsys
-
-def draw_stack(stack, target, drop_frame):
+    global oldsample
+    y = samples.astype(numpy.intp) // 2
+    previous = numpy.concatenate(([oldsample], y[:-1]))
+    oldsample = y[-1]
+    # each sample joins a line to the one before it, two samples per column
+    line = (ROWS >= 127 - numpy.maximum(y, previous)[:, None]) & \
+        (ROWS <= 127 - numpy.minimum(y, previous)[:, None])
+    shadow = numpy.zeros_like(line)
+    shadow[:, 1:] = line[:, :-1]
+    shadows = shadow[0::2] | shadow[1::2]
+    columns = len(shadows)
+    numpy.copyto(target[:columns], BASE02, where=shadows)
+    numpy.copyto(target[1:columns+1], BASE02, where=shadows[:127])
+    # the second shadow covers the first line
+    numpy.copyto(target[:columns], BLUE,
+        where=(line[0::2] & ~shadow[1::2]) | line[1::2])
+
+def hsv_to_rgb(h, s, v):
+    """
+    Converts arrays of hue, saturation and value like colorsys.hsv_to_rgb().
     """
-    Draws the stack as a 16x16 square using a HSV model.
+    i = (h * 6.0).astype(numpy.intp)
+    f = h * 6.0 - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i %= 6
+    r = numpy.choose(i, (v, q, p, p, t, v))
+    g = numpy.choose(i, (t, v, v, q, p, p))
+    b = numpy.choose(i, (p, p, t, v, v, q))
+    return r, g, b
+
+def draw_stack(cells, sp, target):
+    """
+    Draws the stack (cells and top-of-stack pointer as recorded by a
+    glitch_tap.Tap) as a 16x16 square using a HSV model.
 
     Hue is determined by 12 highest bytes.
     Saturation is determined by the next 12 bits.
     Value is determined using the last 8 bits.
     """
-    pixels = pygame.Surface((16, 16), pygame.HWSURFACE)
-    if not drop_frame:
-        stackarray = pygame.surfarray.pixels3d(pixels)
-        for i, value in enumerate(stack):
-            i = i - 1
-            x = (i % 16) + 1
-            y = ((i / 16) % 16) + 1
-            h = (value >> 20 & 0xFFF) / 4095.0
-            s = (value >> 8 & 0xFFF) / 4095.0
-            v = (value & 0xFF) / 255.0
-            r, g, b = colorsys.hsv_to_rgb(h, s, v)
-            stackarray[-x][-y][0] = r * 0xFF
-            stackarray[-x][-y][1] = g * 0xFF
-            stackarray[-x][-y][2] = b * 0xFF
-        del stackarray
-    pixels = pygame.transform.scale(pixels, (128, 128))
-    target.blit(pixels, (0, 0), (0, 0, GRAPH_WIDTH*GRID, GRAPH_HEIGHT*GRID))
+    values = numpy.roll(cells, -1 - int(sp))  # bottom to top, like m.stack
+    h = (values >> 20 & 0xFFF) / 4095.0
+    s = (values >> 8 & 0xFFF) / 4095.0
+    v = (values & 0xFF) / 255.0
+    rgb = numpy.column_stack(hsv_to_rgb(h, s, v)) * 0xFF
+    # the top of the stack goes to the bottom right corner
+    square = numpy.roll(rgb, -1, 0).reshape(16, 16, 3).transpose(1, 0, 2)[::-1, ::-1]
+    square = pygame.surfarray.map_array(graph, square.astype(numpy.uint8))
+    target[:] = square.repeat(8, 0).repeat(8, 1)
 
 RENDER_WAVE = True
 RENDER_YPATTERN = True
@@ -288,51 +362,161 @@ RENDER_STACK = False
 RENDER_ITERATOR = True
 
 def draw_iterator(t):
-    iterator_hex = "%X" % t
-    iterator_length = len(iterator_hex)
-    for i, char in enumerate(iterator_hex):
-        screen.blit(tile(char, MODE_ITERATOR), ((GRAPH_WIDTH+TEXT_WIDTH-iterator_length+i)*GRID, (TEXT_HEIGHT-1)*GRID))
-    pygame.display.update(((GRAPH_WIDTH+TEXT_WIDTH-iterator_length)*GRID, (TEXT_HEIGHT-1)*GRID, TEXT_WIDTH*GRID, GRID))
-
-def draw_graph(buf, stack, t, drop_frame=False):
-    graph = pygame.Surface((128, 128), pygame.HWSURFACE)
-    graph.convert()
-
-    if RENDER_STACK:
-        draw_stack(stack, graph, drop_frame)
-
-    for b in [buf[i:i+256] for i in range(0, len(buf), 256)]:
+    """
+    Redraws the digits of the counter that changed since the last call.
+    """
+    global iterator
+    if RENDER_ITERATOR:
+        new = "%X" % t
+    else:
+        new = ''
+    width = max(len(iterator), len(new))
+    changed = [
+        TEXT_WIDTH-width+i for i, (a, b) in
+        enumerate(zip(iterator.rjust(width), new.rjust(width))) if a != b
+    ]
+    iterator = new
+    pygame.display.update([draw_cell(TEXT_HEIGHT-1, column) for column in changed])
+
+def draw_graph(buf, tap, t):
+    samples = numpy.frombuffer(buf, numpy.uint8)
+
+    if RENDER_STACK and (tap is not None):  # the stack after the block
+        last = tap.snapshots - 1
+        draw_stack(tap.cells[last], tap.pointers[last], graphpixels)
+    else:
+        graphpixels[:] = 0
+
+    for b in [samples[i:i+256] for i in range(0, len(samples), 256)]:
         if RENDER_VALUEPATTERN:
-            draw_valuepattern(b, graph, drop_frame)
+            draw_valuepattern(b, graphpixels)
         if RENDER_YPATTERN:
-            draw_ypattern(b, graph, drop_frame)
+            draw_ypattern(b, graphpixels)
         if RENDER_WAVE:
-            draw_wave(b, graph, drop_frame)
+            draw_wave(b, graphpixels)
 
-    graph = pygame.transform.scale(graph, (GRAPH_WIDTH*GRID, GRAPH_HEIGHT*GRID))
-    screen.blit(graph, (0, 0), (0, 0, GRAPH_WIDTH*GRID, GRAPH_HEIGHT*GRID))
+    pygame.surfarray.blit_array(graph, graphpixels)
+    pygame.transform.scale(graph, (GRAPH_WIDTH*GRID, GRAPH_HEIGHT*GRID), scaledgraph)
+    screen.blit(scaledgraph, (0, 0))
 
     draw_iterator(t)
     pygame.display.update((0, 0, GRAPH_WIDTH*GRID, GRAPH_HEIGHT*GRID))
 
+class Synthesizer(threading.Thread):
+    """
+    Renders blocks of samples ahead of playback into a ring buffer.
+
+    The synthesizer thread is the only writer and the main loop is the only
+    reader; each advances just its own counter, so the ring needs no locks.
+    Changes to the melody are queued as functions and called between two
+    blocks, so every block is rendered by exactly one version of it.
+    """
+    def __init__(self, melody):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.melody = melody
+        self.t = 0
+        self.blocks = [bytearray(BUFSIZE) for n in range(RINGSIZE)]
+        # the state of blocks rendered while the stack is shown
+        self.taps = [glitch_tap.Tap(BUFSIZE) for n in range(RINGSIZE)]
+        self.tapped = [False] * RINGSIZE
+        self.times = [0] * RINGSIZE
+        self.written = 0
+        self.read = 0
+        self.changes = deque()
+        self.wakeup = threading.Event()
+
+    def run(self):
+        while True:
+            while self.changes:
+                self.changes.popleft()()
+            if self.written - self.read < RINGSIZE:
+                slot = self.written % RINGSIZE
+                self.tapped[slot] = RENDER_STACK and \
+                    (self.melody.profile is None)
+                if self.tapped[slot]:
+                    self.melody.tap = self.taps[slot]
+                    self.melody.render(self.t, BUFSIZE, self.blocks[slot])
+                    self.melody.tap = None  # seek renders more at once
+                elif cache is None:
+                    self.melody.render(self.t, BUFSIZE, self.blocks[slot])
+                else:
+                    cache.render(self.melody, self.t, BUFSIZE,
+                        self.blocks[slot])
+                self.t += BUFSIZE
+                self.times[slot] = self.t
+                self.written += 1
+            else:
+                self.wakeup.wait(0.01)
+                self.wakeup.clear()
+
+    def change(self, function):
+        """
+        Calls function in the synthesizer thread at the next block boundary.
+        """
+        self.changes.append(function)
+        self.wakeup.set()
+
+    def get(self):
+        """
+        Returns the next block as (samples, tap or None, t) or None on
+        underrun. Neither is copied; they are not written again until
+        release is called.
+        """
+        if self.read == self.written:
+            return None
+        slot = self.read % RINGSIZE
+        tap = self.taps[slot] if self.tapped[slot] else None
+        return self.blocks[slot], tap, self.times[slot]
+
+    def release(self):
+        """
+        Frees the block returned by get for rendering the next ones.
+        """
+        self.read += 1
+        self.wakeup.set()
+
+def restart():
+    synthesizer.t = 0
+
+def seek(step):
+    synthesizer.t = max(0, synthesizer.t + step)
+    m.seek(synthesizer.t)
+
+def set_char(row, column, char):
+    m.set_char(row, column, char)
+    stderr.write('Now playing: ' + str(m) + '\n')
+
+def stop_profile():
+    stderr.write(m.profile.report() + '\n')
+    m.profile = None
+
+synthesizer = Synthesizer(m)
+synthesizer.start()
+
 channel = pygame.mixer.find_channel()
 running = True
 i = 0
 PAUSED = False
 while running:
-    starttime = time()
     if (channel.get_queue() == None and not PAUSED):  # no excess output
-        buf = [m._compute_(j) for j in range(i, i+BUFSIZE)]
-        sound = pygame.sndarray.make_sound(numpy.array(buf, numpy.uint8))
-        channel.queue(sound)
-        i += BUFSIZE
-
-        drop_frame = ((time() - starttime)*8000 > BUFSIZE)
-        draw_graph(buf, m.stack, i, drop_frame)
-        if drop_frame:
+        block = synthesizer.get()
+        if block is None:
             stderr.write('Dropped frame; your system may be too slow.\n')
+        else:
+            buf, tap, i = block
+            sound = pygame.sndarray.make_sound(numpy.frombuffer(buf, numpy.uint8))
+            channel.queue(sound)
+
+            draw_graph(buf, tap, i)
+            synthesizer.release()
+            if (profile is not None) and (i % (BUFSIZE*32) == 0):
+                draw_controls()  # refresh profile overlay
+    else:
+        pygame.time.wait(1)  # leave the interpreter to the synthesizer
 
     for event in pygame.event.get():
+        cursor = (curpos[1], curpos[0])
         if event.type == pygame.KEYUP:
             if event.key == pygame.K_LEFT:
                 if curpos[0] > 0:
@@ -353,7 +537,13 @@ while running:
                 curpos[0] = 15
 
             if event.key == pygame.K_ESCAPE:
-                i = 0
+                synthesizer.change(restart)
+
+            if event.key == pygame.K_F2:
+                synthesizer.change(lambda: seek(-SEEKSTEP))
+
+            if event.key == pygame.K_F3:
+                synthesizer.change(lambda: seek(SEEKSTEP))
 
             if event.key == pygame.K_PAUSE:
                 PAUSED = not PAUSED
@@ -379,14 +569,26 @@ while running:
             if event.key == pygame.K_F9:
                 RENDER_ITERATOR = not RENDER_ITERATOR
 
+            if event.key == pygame.K_F11:
+                if profile is None:
+                    import glitch_profile
+                    profile = glitch_profile.Profile()
+                    synthesizer.change(lambda: setattr(m, 'profile', profile))
+                else:
+                    synthesizer.change(stop_profile)
+                    profile = None
+                    clear_profile()
+
             if event.key == pygame.K_F10:
                 row = curpos[1]
                 if row in mutedlines:
                     mutedlines = mutedlines.difference([row])
                 else:
                     mutedlines = mutedlines.union([row])
-                m.tokens = m._tokenize_(m.lines[1:], [n-1 for n in mutedlines])
-                m._reset_()
+                if row > 0:  # the title is not code
+                    synthesizer.change(lambda row=row, muted=row in mutedlines:
+                        m.mute_line(row, muted))
+                touch_line(row)
 
             if event.key in list(TEXT_KEYMAP.keys()) or \
                 event.key in list(OPCODE_KEYMAP.keys()) or \
@@ -394,7 +596,7 @@ while running:
                 event.key == pygame.K_PAGEDOWN:
                 column = curpos[0]
                 row = curpos[1]
-                line = m.lines[int(row)]
+                line = lines[int(row)]
                 char = line[int(column)]
 
                 if (row == 0) and (
@@ -426,11 +628,13 @@ while running:
                         index = (KEYORDER.find(char) + 1) % len(KEYORDER)
                         newchar = KEYORDER[index]
 
-                m.lines[int(row)] = line[:int(column)] + newchar + line[int(column)+1:]
-                m.tokens = m._tokenize_(m.lines[1:], mutedlines)
-                m._reset_()
-                stderr.write('Now playing: ' + str(m) + '\n')
+                # drawn at once, recompiled at the next block boundary
+                lines[int(row)] = line[:int(column)] + newchar + line[int(column)+1:]
+                dirty.add((row, column))
+                synthesizer.change(lambda row=row, column=column, char=newchar:
+                    set_char(row, column, char))
 
+            dirty.update([cursor, (curpos[1], curpos[0])])
             draw_controls()
             draw_iterator(i)
 
@@ -444,12 +648,15 @@ while running:
             else:
                 curpos[0] = int(x/GRID - 16)
                 curpos[1] = int(y/GRID)
+                dirty.update([cursor, (curpos[1], curpos[0])])
                 draw_controls()
                 draw_iterator(i)
 
         elif event.type == pygame.QUIT:
-            with open(argv[1], 'w') as f:
-                f.write(str(m) + '\n')
-                stderr.write(str(m) + ' saved.\n')
+            # edits may not have reached the synthesizer yet
+            saved = str(glitch.Melody('!'.join(lines)))
+            with open(arguments[0], 'w') as f:
+                f.write(saved + '\n')
+                stderr.write(saved + ' saved.\n')
 
             running = False
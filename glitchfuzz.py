@@ -0,0 +1,394 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 3 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+
+# Differential testing: generates random glitches following the grammar in
+# FORMAT-draft-erlehmann 2.1 and checks that every way of computing samples
+# gives the same samples and leaves the same stack as Reference, which is
+# the original stack machine with its rotating 256-cell deque. Mismatches
+# are reduced to a small glitch reproducing them.
+
+from argparse import ArgumentParser
+from collections import deque
+from json import dump
+from random import Random
+from sys import stderr, stdout
+from time import perf_counter
+
+from glitch import HEXDIGITS, LINE_MAX, LINES_MAX, MAXINT, NUMBER_MAX, \
+    TITLE_CHARACTERS, GlitchError, Melody, parse
+
+OPCODES_USED = 'abcdefghjklmnopqrstu'
+OPCODES_RESERVED = 'ivwxyzGHIJKLMNOPQRSTUVWXYZ'
+
+class Reference(object):
+    def __init__(self, glitch):
+        """
+        A Reference computes samples of a glitch exactly as the first
+        version of Melody did, token by token on a deque, slowly.
+        """
+        self.tokens = []
+        for line in glitch.split('!')[1:]:
+            number = False  # new lines begin new numbers
+            for char in line:
+                if (char in HEXDIGITS) and number:
+                    self.tokens[-1] += char
+                elif char != '.':
+                    self.tokens.append(char)
+                number = char in HEXDIGITS
+        self.stack = deque([0] * 256)
+
+    def compute(self, t):
+        stack = self.stack
+        for token in self.tokens:
+            if token[0] in HEXDIGITS:
+                stack.append(int(token, 16))
+                stack.popleft()
+            elif token == 'a':  # OP_T
+                stack.append(t & MAXINT)
+                stack.popleft()
+            elif token == 'b':  # OP_PUT
+                a = stack[-1] % 256
+                stack[-a-1] = stack[-2]
+                stack.rotate(1)
+            elif token == 'c':  # OP_DROP
+                stack.rotate(1)
+            elif token == 'o':  # OP_NOT
+                stack[-1] = ~stack[-1] & MAXINT
+            elif token == 'p':  # OP_DUP
+                stack.append(stack[-1])
+                stack.popleft()
+            elif token == 'q':  # OP_PICK
+                a = stack[-1]
+                stack[-1] = stack[-((a - 254) % 256)]
+            elif token == 'r':  # OP_SWAP
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            elif token in BINARY:
+                a = stack.pop()
+                b = stack[-1]
+                stack.rotate(1)
+                stack.append(BINARY[token](b, a) & MAXINT)
+            # other letters are reserved and do nothing
+        return stack[-1] & 0xFF
+
+BINARY = {
+    'd': lambda b, a: b * a,
+    'e': lambda b, a: b // a if a else 0,
+    'f': lambda b, a: b + a,
+    'g': lambda b, a: b - a,
+    'h': lambda b, a: b % a if a else 0,
+    'j': lambda b, a: b << a if a < 32 else 0,
+    'k': lambda b, a: b >> a if a < 32 else 0,
+    'l': lambda b, a: b & a,
+    'm': lambda b, a: b | a,
+    'n': lambda b, a: b ^ a,
+    's': lambda b, a: MAXINT if b < a else 0,
+    't': lambda b, a: MAXINT if b > a else 0,
+    'u': lambda b, a: MAXINT if b == a else 0
+}
+
+def _compute_(m, start, count, buf):
+    for i in range(count):
+        buf[i] = m._compute_(start + i)
+
+def _interpret_(m, start, count, buf):
+    m._interpret_(start & MAXINT, count, buf)
+
+def _codegen_(m, start, count, buf):
+    m._render_(start, count, buf)
+
+def _numpy_(m, start, count, buf):
+    import glitch_numpy
+    glitch_numpy.render(m, start, count, buf)
+
+def _profile_(m, start, count, buf):
+    import glitch_profile
+    glitch_profile.Profile().render(m, start & MAXINT, count, buf)
+
+def _render_(m, start, count, buf):
+    m.render(start, count, buf)
+
+def _blocks_(m, start, count, buf):
+    # stack and t carry over between blocks of varying size
+    view = memoryview(buf)
+    offset = 0
+    for n in [1, 7, 256, 4099] * (count // 4363 + 1):
+        n = min(n, count - offset)
+        m.render(start + offset, n, view[offset:offset+n])
+        offset += n
+
+def _cycles_(m, start, count, buf):
+    # blocks small enough for cycles to be found and copied (see Cycle)
+    m.cycle_block = 16
+    view = memoryview(buf)
+    for offset in range(0, count, 16):
+        n = min(16, count - offset)
+        m.render(start + offset, n, view[offset:offset+n])
+
+def _tap_(m, start, count, buf):
+    # blocks as glitched renders them, snapshots checked against the tops
+    # and the stack they end with
+    import glitch_tap
+    m.tap = tap = glitch_tap.Tap(256, 16)
+    view = memoryview(buf)
+    for offset in range(0, count, 256):
+        n = min(256, count - offset)
+        m.render(start + offset, n, view[offset:offset+n])
+        for j in range(tap.snapshots):
+            if tap.cells[j][tap.pointers[j]] != tap.tops[(j + 1) * 16 - 1]:
+                raise ValueError('snapshot %d differs from its top' % j)
+        if (n % 16 == 0) and (list(tap.stack(tap.snapshots - 1)) != m.stack):
+            raise ValueError('last snapshot differs from the stack')
+
+# name: function(melody, start, count, buf) computing samples into buf
+BACKENDS = {
+    'compute': _compute_,
+    'interpret': _interpret_,
+    'codegen': _codegen_,
+    'numpy': _numpy_,
+    'profile': _profile_,
+    'render': _render_,
+    'blocks': _blocks_,
+    'cycles': _cycles_,
+    'tap': _tap_
+}
+
+def generate(random):
+    """
+    Returns a random glitch following the grammar. Numbers are mostly
+    small, so shifts, PUT and PICK hit interesting cells, and t is
+    frequent, so samples vary.
+    """
+    title = ''.join([random.choice(sorted(TITLE_CHARACTERS)) \
+        for i in range(random.randint(0, LINE_MAX))])
+    lines = []
+    for i in range(min(random.randint(1, 6), random.randint(1, LINES_MAX))):
+        tokens = []
+        length = random.randint(1, LINE_MAX)
+        while len(''.join(tokens)) < length:
+            r = random.random()
+            if r < 0.25:
+                token = 'a'
+            elif r < 0.5:
+                token = _number_(random)
+                if tokens and (tokens[-1][0] in HEXDIGITS):
+                    tokens.append('.')
+            elif r < 0.95:
+                token = random.choice(OPCODES_USED)
+            elif r < 0.97:
+                token = random.choice(OPCODES_RESERVED)
+            else:
+                token = '.'
+            tokens.append(token)
+        line = ''.join(tokens)[:LINE_MAX]
+        if line[-1] == '.':  # may have been cut off after a period
+            line = line[:-1] + 'a'
+        lines.append(line)
+    return title + '!' + '!'.join(lines)
+
+def _number_(random):
+    r = random.random()
+    if r < 0.6:
+        value = random.randint(0, 40)
+    elif r < 0.8:
+        value = random.randint(0, 0xFF)
+    else:
+        value = random.getrandbits(4 * random.randint(1, NUMBER_MAX))
+    return '%X' % value
+
+def compare(glitch, start, count, backends):
+    """
+    Computes count samples of glitch beginning at t = start with Reference
+    and every backend. Returns the reference samples and, per backend,
+    (seconds, index of the first differing sample or -1 if only the
+    stack differs, or None if nothing differs, the exception raised
+    or None).
+    """
+    reference = Reference(glitch)
+    expected = bytes([reference.compute(start + i) for i in range(count)])
+    stack = list(reference.stack)
+
+    results = {}
+    for name in backends:
+        m = Melody(glitch)
+        buf = bytearray(count)
+        starttime = perf_counter()
+        try:
+            BACKENDS[name](m, start, count, buf)
+        except Exception as error:
+            results[name] = (0.0, 0, error)
+            continue
+        seconds = perf_counter() - starttime
+        if buf != expected:
+            index = [a == b for a, b in zip(buf, expected)].index(False)
+        elif m.stack != stack:
+            index = -1
+        else:
+            index = None
+        results[name] = (seconds, index, None)
+    return expected, results
+
+def _tokens_(line):
+    tokens = []
+    number = False
+    for char in line:
+        if (char in HEXDIGITS) and number:
+            tokens[-1] += char
+        elif char != '.':
+            tokens.append(char)
+        number = char in HEXDIGITS
+    return tokens
+
+def _join_(lines):
+    result = []
+    for tokens in lines:
+        line = ''
+        for token in tokens:
+            if line and (line[-1] in HEXDIGITS) and (token[0] in HEXDIGITS):
+                line += '.'
+            line += token
+        result.append(line)
+    return '!' + '!'.join(result)
+
+def minimize(glitch, start, count, name):
+    """
+    Returns a smaller glitch, start and count for which backend name still
+    differs from Reference: fewer samples, lines and tokens, and smaller
+    numbers, until no single change keeps the mismatch.
+    """
+    def fails(lines, count):
+        if not any(lines):
+            return False
+        return compare(_join_(lines), start, count, [name])[1][name][1] \
+            is not None
+
+    lines = [_tokens_(line) for line in glitch.split('!')[1:]]
+    index = compare(glitch, start, count, [name])[1][name][1]
+    if index >= 0:  # no samples after the first mismatch are needed
+        count = index + 1
+
+    changed = True
+    while changed:
+        changed = False
+        candidates = []
+        for i in range(len(lines)):
+            candidates.append(lines[:i] + lines[i+1:])
+            for j in range(len(lines[i])):
+                line = lines[i]
+                candidates.append(lines[:i] + [line[:j] + line[j+1:]] + \
+                    lines[i+1:])
+                if line[j][0] in HEXDIGITS:
+                    value = int(line[j], 16)
+                    for smaller in (0, 1, value >> 1):
+                        if smaller < value:
+                            candidates.append(lines[:i] + [line[:j] + \
+                                ['%X' % smaller] + line[j+1:]] + lines[i+1:])
+        for n in (1, count >> 1):
+            if (0 < n < count) and fails(lines, n):
+                count = n
+                changed = True
+                break
+        for candidate in candidates:
+            candidate = [tokens for tokens in candidate if tokens]
+            if fails(candidate, count):
+                lines = candidate
+                changed = True
+                break
+    return _join_(lines), start, count
+
+if __name__ == '__main__':
+    parser = ArgumentParser(usage='glitchfuzz.py [OPTIONS]')
+    parser.add_argument('--programs', metavar='N', type=int, default=200,
+        help='number of random glitches tried (default: 200)')
+    parser.add_argument('--samples', metavar='N', type=int, default=4096,
+        help='samples computed per glitch and range of t (default: 4096)')
+    parser.add_argument('--seed', metavar='N', type=int, default=0,
+        help='seed of the random glitches (default: 0)')
+    parser.add_argument('--backends', metavar='NAMES',
+        default=','.join(sorted(BACKENDS)),
+        help='comma-separated backends to check (default: all of %s)' % \
+            ', '.join(sorted(BACKENDS)))
+    parser.add_argument('--output', metavar='JSON',
+        help='save throughput and mismatches to JSON')
+    args = parser.parse_args()
+
+    backends = args.backends.split(',')
+    for name in backends:
+        if name not in BACKENDS:
+            parser.error('unknown backend %s' % name)
+    if 'numpy' in backends:
+        try:
+            import numpy
+        except ImportError:
+            stderr.write('NumPy is not available, skipping backend numpy.\n')
+            backends.remove('numpy')
+
+    random = Random(args.seed)
+    seconds = dict((name, 0.0) for name in backends)
+    samples = 0
+    mismatches = []
+    for i in range(args.programs):
+        glitch = generate(random)
+        try:
+            parse(glitch, strict=True)
+        except GlitchError as error:
+            mismatches.append({'glitch': glitch, 'backend': 'parse',
+                'diagnostics': error.diagnostics})
+            stdout.write('%s is not valid: %s\n' % (glitch, error))
+            continue
+
+        # t from zero, anywhere, and wrapping around
+        for start in (0, random.getrandbits(32) & ~0xFFFF,
+            MAXINT + 1 - args.samples // 2):
+            expected, results = compare(glitch, start, args.samples, backends)
+            samples += args.samples
+            for name, (elapsed, index, error) in sorted(results.items()):
+                seconds[name] += elapsed
+                if index is None:
+                    continue
+                if error is not None:
+                    problem = 'raised %r' % error
+                elif index < 0:
+                    problem = 'STACK MISMATCH'
+                else:
+                    problem = 'MISMATCH at sample %d' % index
+                small, small_start, small_count = \
+                    minimize(glitch, start, args.samples, name)
+                mismatches.append({'glitch': glitch, 'backend': name,
+                    'start': start, 'problem': problem, 'reproducer': small,
+                    'reproducer_start': small_start,
+                    'reproducer_count': small_count})
+                stdout.write('%s %s from t = %d for %s; reproduced by %s '
+                    'from t = %d, %d samples\n' % (name, problem, start,
+                        glitch, small, small_start, small_count))
+
+    for name in sorted(backends):
+        stdout.write('%-12s %10.0f/s\n' % (name,
+            samples / seconds[name] if seconds[name] else 0.0))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            dump({'seed': args.seed, 'programs': args.programs,
+                'samples': args.samples, 'mismatches': mismatches,
+                'samples_per_second': dict((name, samples / seconds[name] \
+                    if seconds[name] else 0.0) for name in backends)},
+                f, indent=1, sort_keys=True)
+
+    if mismatches:
+        stderr.write('%d mismatches.\n' % len(mismatches))
+        exit(1)
@@ -16,18 +16,156 @@
 #       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #       MA 02110-1301, USA.
 
-from sys import argv, stderr, stdout
 
-from glitch import Melody
+from argparse import ArgumentParser
+from os import makedirs, path
+from sys import stderr, stdout
 
-if len(argv) == 1:
-    stderr.write('Usage: glitter.py [FORMULA]\n')
-    exit(1)
+from glitch import GlitchError, Melody, SAMPLERATE, render_parallel, \
+    render_batch, wav_header
 
-m = Melody(argv[1])
-stderr.write(str(m))
+parser = ArgumentParser(
+    usage='glitter.py [OPTIONS] FORMULA\n' +
+        '       glitter.py --mix [OPTIONS] FORMULA...\n' +
+        '       glitter.py --samples N --batch DIRECTORY [OPTIONS] FILE...')
+parser.add_argument('inputs', metavar='FORMULA', nargs='+')
+parser.add_argument('--samples', '--render', metavar='N', type=int,
+    help='write N samples and exit instead of playing forever')
+parser.add_argument('--seconds', metavar='S', type=float,
+    help='write S seconds of samples and exit')
+parser.add_argument('--format', choices=['raw', 'wav'], default='raw',
+    help='write bare samples or a WAVE file (default: raw)')
+parser.add_argument('--rate', metavar='HZ', type=int, default=SAMPLERATE,
+    help='sample rate for --seconds and WAVE headers (default: %d)' % \
+        SAMPLERATE)
+parser.add_argument('--bits', type=int, choices=[8, 16], default=8,
+    help='write unsigned 8-bit or signed 16-bit samples (default: 8)')
+parser.add_argument('--resample', choices=['direct', 'hold', 'bandlimited'],
+    default='direct', help='let t run at --rate, or compute samples at '
+        '%d Hz and repeat or interpolate them (default: direct)' % SAMPLERATE)
+parser.add_argument('--output', metavar='FILE', default='-',
+    help='write to FILE instead of standard output')
+parser.add_argument('--jobs', metavar='K', type=int,
+    help='number of processes used for rendering (default: one per CPU)')
+parser.add_argument('--batch', metavar='DIRECTORY',
+    help='render glitch files given as arguments into DIRECTORY')
+parser.add_argument('--strict', action='store_true',
+    help='refuse glitches not following the format instead of warning')
+parser.add_argument('--mix', action='store_true',
+    help='play all FORMULAs at once, each at the same volume')
+parser.add_argument('--cache', action='store_true',
+    help='keep samples on disk and read them from there when played again')
+parser.add_argument('--cache-dir', metavar='DIRECTORY',
+    help='keep samples for --cache in DIRECTORY (default: '
+        '~/.cache/libglitch); implies --cache')
+parser.add_argument('--cache-size', metavar='MB', type=int, default=256,
+    help='megabytes of samples kept by --cache (default: 256)')
+args = parser.parse_args()
 
+count = args.samples
+if args.seconds is not None:
+    count = int(args.seconds * args.rate)
+
+if args.batch:
+    if count is None:
+        parser.error('--batch requires --samples or --seconds')
+    if args.mix or args.cache or (args.cache_dir is not None) or \
+        (args.bits != 8) or (args.resample != 'direct'):
+        parser.error('--batch only writes 8-bit samples, without --mix, '
+            '--cache or --resample')
+    files = []
+    for inpath in args.inputs:
+        name = path.splitext(path.basename(inpath))[0]
+        files.append((inpath, path.join(args.batch, name + '.' + args.format)))
+    makedirs(args.batch, exist_ok=True)
+    for outpath in render_batch(files, count, args.jobs, args.format,
+        args.rate):
+        stderr.write(outpath + '\n')
+    exit(0)
+
+if (len(args.inputs) != 1) and not args.mix:
+    parser.error('exactly one FORMULA expected')
+if args.mix and (args.resample != 'direct'):
+    parser.error('--mix can not be combined with --resample')
+if args.cache_dir is not None:
+    args.cache = True
+if args.cache and (args.mix or (args.bits != 8) or \
+    (args.resample != 'direct')):
+    parser.error('--cache only keeps 8-bit samples of a single FORMULA')
+
+melodies = []
+for formula in args.inputs:
+    try:
+        m = Melody(formula, strict=args.strict)
+    except GlitchError as error:
+        stderr.write(str(error) + '\n')
+        exit(1)
+    for warning in m.warnings:
+        stderr.write('line %d, column %d: %s\n' % warning)
+    stderr.write(str(m) + '\n' * args.mix)
+    melodies.append(m)
+
+if args.mix:
+    from glitch_mixer import Mixer, Voice
+    mixer = Mixer(args.bits, jobs=args.jobs)
+    for m in melodies:
+        mixer.add(Voice(m, 1.0 / len(melodies)))
+elif (args.bits != 8) or (args.resample != 'direct'):
+    from glitch_resample import Resampler
+    resampler = Resampler(m, args.rate, args.bits, args.resample)
+else:
+    resampler = None
+
+if args.cache:
+    import glitch_cache
+    cache = glitch_cache.Cache(args.cache_dir or glitch_cache.DIRECTORY,
+        args.cache_size << 20)
+else:
+    cache = None
+
+if args.output == '-':
+    output = getattr(stdout, 'buffer', stdout)
+else:
+    output = open(args.output, 'wb')
+
+if args.format == 'wav':
+    output.write(wav_header(count, args.rate, args.bits))
+
+if count is not None:
+    if args.mix:
+        output.write(mixer.render(count))
+    elif resampler:
+        output.write(resampler.render(count))
+    elif cache:
+        for offset in range(0, count, glitch_cache.BLOCKSIZE):
+            output.write(cache.render(m, offset,
+                min(glitch_cache.BLOCKSIZE, count - offset)))
+    else:
+        output.write(render_parallel(m, 0, count, args.jobs))
+    output.close()
+    exit(0)
+
+if cache:  # whole blocks, so melodies keeping their stack can be read
+    BLOCKSIZE = glitch_cache.BLOCKSIZE
+else:
+    BLOCKSIZE = 4096
+
+buf = bytearray(BLOCKSIZE * args.bits // 8)
 i = 0
-while True:
-    stdout.write(chr(m._compute_(i)))
-    i += 1
+try:
+    while True:
+        if args.mix:
+            output.write(mixer.render(BLOCKSIZE, buf))
+        elif resampler:
+            output.write(resampler.render(BLOCKSIZE, buf))
+        elif cache:
+            output.write(cache.render(m, i, BLOCKSIZE))
+        else:
+            output.write(m.render(i, BLOCKSIZE, buf))
+        i += BLOCKSIZE
+except (KeyboardInterrupt, BrokenPipeError):
+    # a file can be given the correct length after the fact
+    if (args.format == 'wav') and output.seekable():
+        output.seek(0)
+        output.write(wav_header(i, args.rate, args.bits))
+    output.close()
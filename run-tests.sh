@@ -1,6 +1,17 @@
 #!/bin/sh
 
+set -e  # any failing check fails the tests
+
 for f in `ls -1 tests/*.glitch`; do
     echo $f
     ./glitter.py `cat $f` | head -c512;
 done
+
+# output must match the hashes recorded in tests/golden.json
+./glitchbench.py --hashes-only --compare tests/golden.json > /dev/null
+
+# every backend must compute the same as the original stack machine
+./glitchfuzz.py --programs 20 > /dev/null
+
+# short renders must not import accelerators (times are only reported)
+./glitchbench.py --startup > /dev/null